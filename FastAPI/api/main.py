@@ -1,10 +1,28 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
+from fastapi.responses import Response
 from routes import image_routes
+from services import executor, metrics, registry
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    registry.warm_up()
+    yield
+    executor.shutdown()
 
-app = FastAPI()
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(metrics.MetricsMiddleware)
 
 @app.get("/")
 def root():
     return {"message": "Hello from FastAPI on Vercel!"}
 
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """Request, render and pool metrics in the Prometheus text format."""
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
 app.include_router(image_routes.router, prefix="/api")
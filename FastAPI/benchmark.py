@@ -0,0 +1,265 @@
+"""
+Offline benchmark of every filter in services/filters and services/enhance.
+
+Each filter's function is called directly, without the server, on the same
+synthetic photo at several sizes. Three stages are measured separately:
+decoding the upload, the filter itself and encoding the result in the
+filter's default format. For each stage the suite records:
+
+- wall time and CPU time (median of --repeat runs);
+- peak Python/numpy allocations (tracemalloc);
+- peak resident memory growth (RSS, sampled).
+
+Memory is measured in one extra run, so tracing never skews the timings.
+
+Usage:
+    python benchmark.py --output bench.json
+    python benchmark.py --filters oil_paint,cartoon --sizes 0.3,2 --baseline bench.json
+
+With --baseline, every stage that got slower (or hungrier) than the
+baseline by more than --threshold is reported, and the exit status is 1.
+Results are only comparable between runs on the same machine.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+from services import registry
+from services.encoding import default_encoding
+from services.utils import decode_image
+
+# Input sizes in megapixels.
+DEFAULT_SIZES = (0.3, 2, 12, 24)
+
+# Source of the synthetic input; resized to every benchmark size.
+IMAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "image.png")
+
+# Inputs are 4:3, like most camera photos.
+ASPECT = 4 / 3
+
+# Changes below this many milliseconds (or megabytes) are noise, whatever
+# the ratio.
+MIN_TIME_DELTA_MS = 5.0
+MIN_MEMORY_DELTA_MB = 8.0
+
+# Seconds between RSS samples while a stage runs.
+RSS_INTERVAL = 0.002
+
+STAGES = ("decode", "filter", "encode")
+
+
+def make_input(megapixels: float) -> bytes:
+    """
+    The benchmark input at `megapixels`, as JPEG bytes. The photo is resized
+    to size and given seeded sensor-like noise, so upscaled sizes still have
+    texture and every run sees the same pixels.
+    """
+    height = int(round((megapixels * 1e6 / ASPECT) ** 0.5))
+    width = int(round(height * ASPECT))
+    source = cv2.imread(IMAGE_PATH)
+    img = cv2.resize(source, (width, height), interpolation=cv2.INTER_CUBIC)
+    noise = np.random.default_rng(0).normal(0, 4, img.shape)
+    img = np.clip(img + noise, 0, 255).astype(np.uint8)
+    success, encoded = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 92])
+    if not success:
+        raise RuntimeError("Could not encode the benchmark input")
+    return encoded.tobytes()
+
+
+def benchmark_params(spec) -> dict:
+    """
+    The filter's default params, seeded where the filter is random and
+    resolved like on an idle server (e.g. denoise's mode=auto).
+    """
+    params = spec.parse_params({})
+    if "seed" in params and params["seed"] is None:
+        params["seed"] = 0
+    if spec.under_load is not None:
+        params = spec.under_load(params, 0.0)
+    return params
+
+
+def _rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+class _RssSampler:
+    """Tracks the peak RSS of this process while in a with-block (Linux only)."""
+
+    def __enter__(self):
+        self.start = self.peak = _rss_bytes()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(RSS_INTERVAL):
+            self.peak = max(self.peak, _rss_bytes())
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, _rss_bytes())
+
+    @property
+    def growth(self) -> int:
+        return self.peak - self.start
+
+
+def _time(fn):
+    """Returns (result, wall ms, CPU ms) of one call."""
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = fn()
+    return result, (time.perf_counter() - wall) * 1000, (time.process_time() - cpu) * 1000
+
+
+def _memory(fn) -> dict:
+    """Peak tracemalloc and RSS growth of one call, in megabytes."""
+    tracemalloc.start()
+    try:
+        with _RssSampler() as rss:
+            fn()
+        _, traced_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"traced_peak_mb": round(traced_peak / 2**20, 2), "rss_peak_mb": round(rss.growth / 2**20, 2)}
+
+
+def run_case(spec, contents: bytes, repeat: int) -> dict:
+    """Benchmarks the decode, filter and encode stages of one filter on one input."""
+    params = benchmark_params(spec)
+    encoding = default_encoding(spec, params)
+
+    img = decode_image(contents)
+    output = spec.func(img, **params)
+    stages = {
+        "decode": lambda: decode_image(contents),
+        "filter": lambda: spec.func(img, **params),
+        # Text outputs (see registry.TEXT_FORMATS) are sent as UTF-8.
+        "encode": (lambda: output.encode("utf-8")) if isinstance(output, str) else (lambda: encoding.encode(output)),
+    }
+
+    case = {"params": params, "format": encoding.format,
+            "input": {"width": img.shape[1], "height": img.shape[0]}}
+    for stage in STAGES:
+        walls, cpus = [], []
+        for _ in range(repeat):
+            cv2.setRNGSeed(0)
+            _, wall, cpu = _time(stages[stage])
+            walls.append(wall)
+            cpus.append(cpu)
+        cv2.setRNGSeed(0)
+        case[stage] = {
+            "wall_ms": round(statistics.median(walls), 2),
+            "cpu_ms": round(statistics.median(cpus), 2),
+            **_memory(stages[stage]),
+        }
+    return case
+
+
+def metadata(sizes, repeat: int) -> dict:
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "opencv_threads": cv2.getNumThreads(),
+        "cpu_count": os.cpu_count(),
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "sizes_mp": list(sizes),
+        "repeat": repeat,
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    Stages of `results` that regressed against `baseline`.
+
+    Returns:
+        One line per regression: wall or CPU time, or peak memory, grown
+        by more than `threshold` (a fraction) and by more than the noise
+        floor.
+    """
+    regressions = []
+    checks = (("wall_ms", MIN_TIME_DELTA_MS), ("cpu_ms", MIN_TIME_DELTA_MS),
+              ("traced_peak_mb", MIN_MEMORY_DELTA_MB), ("rss_peak_mb", MIN_MEMORY_DELTA_MB))
+    for case_key, case in results["results"].items():
+        base_case = baseline.get("results", {}).get(case_key)
+        if base_case is None:
+            continue
+        for stage in STAGES:
+            for metric, floor in checks:
+                new, old = case[stage][metric], base_case.get(stage, {}).get(metric)
+                if old is None:
+                    continue
+                if new - old > floor and new > old * (1 + threshold):
+                    ratio = new / old if old else float("inf")
+                    regressions.append(f"{case_key} {stage} {metric}: {old} -> {new} ({ratio:.2f}x)")
+    return regressions
+
+
+def _case_key(name: str, megapixels: float) -> str:
+    return f"{name}@{megapixels:g}MP"
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark every filter offline.")
+    parser.add_argument("--filters", help="Comma-separated filter names (default: all).")
+    parser.add_argument("--sizes", help="Comma-separated input sizes in megapixels "
+                                        f"(default: {','.join(f'{s:g}' for s in DEFAULT_SIZES)}).")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per stage; the median is kept.")
+    parser.add_argument("--output", default="benchmark.json", help="Where to write the results.")
+    parser.add_argument("--baseline", help="Earlier results to compare against.")
+    parser.add_argument("--threshold", type=float, default=0.15,
+                        help="Relative growth reported as a regression (default: 0.15).")
+    args = parser.parse_args(argv)
+
+    names = args.filters.split(",") if args.filters else registry.filter_names()
+    unknown = [name for name in names if name not in registry.filter_names()]
+    if unknown:
+        parser.error(f"unknown filters: {', '.join(unknown)}")
+    sizes = [float(s) for s in args.sizes.split(",")] if args.sizes else list(DEFAULT_SIZES)
+
+    results = {"meta": metadata(sizes, args.repeat), "results": {}}
+    for megapixels in sizes:
+        contents = make_input(megapixels)
+        for name in names:
+            spec = registry.get_filter(name)
+            case = run_case(spec, contents, args.repeat)
+            results["results"][_case_key(name, megapixels)] = case
+            print(f"{_case_key(name, megapixels):<24}"
+                  + "".join(f" {stage} {case[stage]['wall_ms']:>9.1f}ms" for stage in STAGES)
+                  + f"  filter peak {case['filter']['traced_peak_mb']:.0f}MB", flush=True)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            return 1
+        print(f"No regressions against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
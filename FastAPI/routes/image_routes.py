@@ -1,142 +1,326 @@
-from fastapi import APIRouter, UploadFile, File
-from fastapi.responses import StreamingResponse
-from fastapi import Query 
-from services.filters import grayscale, canny, invert , sketch, pixelate, comic , oil_paint, color_sketch, water_color, heat, ascii_art, frost, xray, cartoon , dot , thread , retro , neon , haunted
-from services.enhance import auto_brightness, auto_enhance, denoise, shadow_removal, sharpen , bgrem
+import json
+from typing import List, Literal, Optional
+
+from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Query, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from services import batch, cache, fanout, registry
+from services.encoding import OutputOptions
+from services.executor import check_room, result_key, run_light, run_pipeline, run_task, store_upload
+from services.image_store import StoredImage, images
+from services.jobs import jobs
+from services.utils import decode_image, env_int
 
 
 router = APIRouter()
 
+IMAGE_ID_QUERY = Query(None, description="Handle from POST /api/images, used instead of uploading a file.")
+MAX_DIM_QUERY = Query(None, ge=16, description="Downscale so the long edge is at most this many pixels before filtering.")
+PREVIEW_QUERY = Query(False, description="Render a fast low-resolution preview.")
+FULL_RENDER_QUERY = Query(False, description="With preview: also start a full-resolution background job, "
+                                             "returned in the X-Full-Render-Job header.")
+FORMAT_QUERY = Query(None, description="Output format. Defaults to WebP if the Accept header lists it, "
+                                       "else the filter's own format (lossless PNG for line art).")
+QUALITY_QUERY = Query(None, ge=1, le=100, description="JPEG or WebP quality.")
+COMPRESSION_QUERY = Query(None, ge=0, le=9, description="PNG compression level; higher is smaller but slower.")
+
+# Results up to this size are sent in a single body message; larger ones are
+# streamed in slices of this size so the server can interleave other work.
+STREAM_CHUNK_BYTES = env_int("SHARPIFY_STREAM_CHUNK_BYTES", 1024 * 1024)
+
+
+async def _read_source(file: Optional[UploadFile], image_id: Optional[str]):
+    """Returns (source, key): the upload bytes or a StoredImage, and the digest of the bytes."""
+    if (file is None) == (image_id is None):
+        raise RequestValidationError([{
+            "type": "value_error",
+            "loc": ("body", "file"),
+            "msg": "Provide exactly one of an uploaded file or an image_id",
+            "input": None,
+        }])
+    if image_id is not None:
+        stored = images.get(image_id)
+        return stored, stored.source_key
+    contents = await file.read()
+    return contents, await cache.digest_async(contents)
+
+
+def _at_size(source, key: str, max_dim: Optional[int]):
+    """Returns (source, source_key) for run_pipeline, using the best stored copy for handles."""
+    if isinstance(source, StoredImage):
+        long_edge, img = source.variant(max_dim)
+        return img, f"{key}@{long_edge}"
+    return source, key
+
+
+def _respond(data, media_type: str, headers: dict = None):
+    """
+    Sends an encoded result (bytes, a memoryview or an encoder buffer)
+    without copying it, with its Content-Length.
+    """
+    data = memoryview(data)
+    if len(data) <= STREAM_CHUNK_BYTES:
+        return Response(data, media_type=media_type, headers=headers)
+
+    async def chunks():
+        for start in range(0, len(data), STREAM_CHUNK_BYTES):
+            yield data[start:start + STREAM_CHUNK_BYTES]
+
+    headers = {**(headers or {}), "Content-Length": str(len(data))}
+    return StreamingResponse(chunks(), media_type=media_type, headers=headers)
+
+
+def _output_options(request: Request, format, quality, compression) -> OutputOptions:
+    return OutputOptions(format, quality, compression, request.headers.get("accept"))
+
+
+async def _render(pipeline: list, source, key: str, max_dim: Optional[int], preview: bool, full_render: bool,
+                  options: OutputOptions):
+    specs = [spec for spec, _ in pipeline]
+    last_spec, last_params = pipeline[-1]
+    encoding = options.encoding_for(last_spec.format_for(last_params))
+    media_type = encoding.media_type
+    full_dim = registry.resolve_max_dim(specs, max_dim)
+    # The format may depend on the Accept header.
+    headers = {"Vary": "Accept"}
+
+    if not preview:
+        result = await run_pipeline(pipeline, *_at_size(source, key, full_dim), full_dim, encoding)
+        return _respond(result, media_type, headers)
+
+    preview_dim = min(full_dim or registry.PREVIEW_DIM, registry.PREVIEW_DIM)
+    preview_steps = [(spec, spec.with_preview(params)) for spec, params in pipeline]
+    result = await run_pipeline(preview_steps, *_at_size(source, key, preview_dim), preview_dim, encoding)
+
+    if full_render:
+        # Started after the preview so the preview never waits behind it.
+        full_source, full_key = _at_size(source, key, full_dim)
+        job = jobs.submit(
+            lambda: run_pipeline(pipeline, full_source, full_key, full_dim, encoding),
+            media_type,
+            job_id=result_key(pipeline, full_source, full_key, full_dim, encoding),
+        )
+        if job is not None:
+            headers["X-Full-Render-Job"] = job.job_id
+    return _respond(result, media_type, headers)
+
+
 # =================================
-# Image Enhancement Endpoints
+# Filter Registry
 # =================================
-@router.post("/denoise")
-async def apply_denoise(file: UploadFile = File(...),strength: int = Query(10, ge=1, le=50, description="Denoising strength for NLM. Higher is stronger.")):
-    result_stream = await denoise.process(file, strength_h=strength)
-    return StreamingResponse(result_stream, media_type="image/jpeg")
+@router.get("/filters")
+async def list_filters():
+    return [spec.describe() for spec in registry.all_filters().values()]
 
-@router.post("/sharpen")
-async def apply_sharpen(file: UploadFile = File(...), amount: float = Query(1.0, ge=0.1, le=5.0, description="Amount of sharpening. 1.0 is a moderate sharpen.")): 
-    result_stream = await sharpen.process(file, amount=amount)
-    return StreamingResponse(result_stream, media_type="image/jpeg")
+@router.get("/filters/imports")
+async def filter_import_report():
+    """Import cost per filter module; filters are imported on first use."""
+    return registry.import_report()
 
-@router.post("/auto_enhance")
-async def apply_auto_enhance(file: UploadFile = File(...)):
-    result_stream = await auto_enhance.process(file)
-    return StreamingResponse(result_stream, media_type="image/jpeg")
 
-@router.post("/auto_brightness")  #✅
-async def apply_auto_brightness(file: UploadFile = File(...)):
-    result_stream = await auto_brightness.process(file)
-    return StreamingResponse(result_stream, media_type="image/jpeg")
-
-@router.post("/shadow_removal")  #✅
-async def apply_shadow_removal(file: UploadFile = File(...)):
-    result_stream = await shadow_removal.process(file)
-    return StreamingResponse(result_stream, media_type="image/jpeg")
-
-
-@router.post("/bgrem")  #✅
-async def bgrem(file: UploadFile = File(...)):
-    result_stream = await bgrem.process(file)
-    return StreamingResponse(result_stream, media_type="image/jpeg")
-
-
-# =================================
-# Image Filter Endpoints
-# =================================
-@router.post("/canny")  #✅
-async def apply_canny_edge(file: UploadFile = File(...)):
-    result = await canny.process(file)
-    return StreamingResponse(result, media_type="image/jpeg")
-
-@router.post("/comic")  #✅
-async def comicify(file: UploadFile = File(...)):
-    result = await comic.process(file)
-    return StreamingResponse(result, media_type="image/jpeg")
-
-@router.post("/sketch")  #✅
-async def sketchify(file: UploadFile = File(...)):
-    result = await sketch.process(file)
-    return StreamingResponse(result, media_type="image/jpeg")
-
-@router.post("/dot")  #✅
-async def dotify(file: UploadFile = File(...)):
-    result = await dot.process(file)
-    return StreamingResponse(result, media_type="image/jpeg")
-
-@router.post("/oil_paint")  #✅
-async def apply_oil_paint(file: UploadFile = File(...)):
-    result = await oil_paint.process(file)
-    return StreamingResponse(result, media_type="image/jpeg")
-
-@router.post("/retro")  #✅
-async def apply_retro(file: UploadFile = File(...)):
-    result = await retro.process(file)
-    return StreamingResponse(result, media_type="image/jpeg")
-
-@router.post("/neon")  #✅
-async def apply_neon(file: UploadFile = File(...)):
-    result = await neon.process(file)
-    return StreamingResponse(result, media_type="image/jpeg")
-
-@router.post("/haunted")  #✅
-async def apply_haunted(file: UploadFile = File(...)):
-    result = await haunted.process(file)
-    return StreamingResponse(result, media_type="image/jpeg")
-
-@router.post("/color_sketch")  #✅
-async def color_sketchify(file: UploadFile = File(...)):
-    result = await color_sketch.process(file)
-    return StreamingResponse(result, media_type="image/jpeg")
-
-@router.post("/water_color")  #✅
-async def apply_water_color(file: UploadFile = File(...)):
-    result = await water_color.process(file)
-    return StreamingResponse(result, media_type="image/jpeg")
-
-@router.post("/heat")  #✅
-async def apply_heat(file: UploadFile = File(...)):
-    result = await heat.process(file)
-    return StreamingResponse(result, media_type="image/jpeg")
-
-@router.post("/ascii_art")  #✅
-async def convert_to_ascii(file: UploadFile = File(...)):
-    result = await ascii_art.process(file)
-    return StreamingResponse(result, media_type="image/jpeg")
-
-@router.post("/thread")  #✅
-async def threadify(file: UploadFile = File(...)):
-    result = await thread.process(file)
-    return StreamingResponse(result, media_type="image/jpeg")
-
-@router.post("/frost")  #✅
-async def apply_frost(file: UploadFile = File(...)):
-    result = await frost.process(file)
-    return StreamingResponse(result, media_type="image/jpeg")
-
-@router.post("/xray")  #✅
-async def apply_xray(file: UploadFile = File(...)):
-    result = await xray.process(file)
-    return StreamingResponse(result, media_type="image/jpeg")
-
-@router.post("/cartoon")  #✅
-async def apply_cartoon(file: UploadFile = File(...)):
-    result = await cartoon.process(file)
-    return StreamingResponse(result, media_type="image/jpeg")
-
-                           
-@router.post("/grayscale")  #✅
-async def convert_to_grayscale(file: UploadFile = File(...)):
-    result = await grayscale.process(file)
-    return StreamingResponse(result, media_type="image/jpeg")
-
-@router.post("/invert")  #✅
-async def invert_image(file: UploadFile = File(...)):
-    result = await invert.process(file)
-    return StreamingResponse(result, media_type="image/jpeg")
-
-@router.post("/pixelate")  #✅
-async def pixelate_image(file: UploadFile = File(...)):
-    result = await pixelate.process(file)
-    return StreamingResponse(result, media_type="image/jpeg")
+# =================================
+# Image Handles
+# =================================
+# Upload once, then apply any number of filters by image_id without sending
+# or decoding the image again.
+@router.post("/images")
+async def upload_image(file: UploadFile = File(...)):
+    stored = await store_upload(await file.read())
+    return stored.describe()
+
+@router.delete("/images/{image_id}")
+async def delete_image(image_id: str):
+    if not images.discard(image_id):
+        raise HTTPException(status_code=404, detail=f"Unknown or expired image_id '{image_id}'")
+    return {"deleted": image_id}
+
+
+# =================================
+# Background Jobs
+# =================================
+# Full-resolution renders started by ?preview=true. Poll until the job is done:
+# 202 while pending, then the image (or the error that stopped it).
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = jobs.get(job_id)
+    if job.status == "pending":
+        return JSONResponse(job.describe(), status_code=202)
+    if job.status == "failed":
+        return JSONResponse(job.describe(), status_code=job.status_code)
+    return _respond(job.result, job.media_type)
+
+
+# =================================
+# Pipeline Endpoint
+# =================================
+# Chains several filters on one decoded image: one upload, one decode and one
+# encode however many steps there are. Must be declared before /{filter_name}.
+@router.post("/pipeline")
+async def apply_pipeline(
+    request: Request,
+    file: Optional[UploadFile] = File(None),
+    steps: str = Form(..., description='JSON list, e.g. [{"filter": "sharpen", "params": {"amount": 1.5}}]'),
+    image_id: Optional[str] = IMAGE_ID_QUERY,
+    max_dim: Optional[int] = MAX_DIM_QUERY,
+    preview: bool = PREVIEW_QUERY,
+    full_render: bool = FULL_RENDER_QUERY,
+    format: Optional[Literal["jpeg", "png", "webp"]] = FORMAT_QUERY,
+    quality: Optional[int] = QUALITY_QUERY,
+    compression: Optional[int] = COMPRESSION_QUERY,
+):
+    pipeline = registry.parse_pipeline(steps)
+    source, key = await _read_source(file, image_id)
+    options = _output_options(request, format, quality, compression)
+    return await _render(pipeline, source, key, max_dim, preview, full_render, options)
+
+
+# =================================
+# Interactive Background Removal
+# =================================
+# Segments a stored image and keeps the GrabCut state with its handle, so each
+# call with new hints resumes from the previous result instead of restarting.
+@router.post("/bgrem/refine")
+async def refine_background(
+    request: Request,
+    image_id: str = Query(..., description="Handle from POST /api/images."),
+    hints: Optional[UploadFile] = File(None, description="Image marking pixels to keep (opaque white) "
+                                                         "or remove (opaque black)."),
+    reset: bool = Query(False, description="Discard the previous session and start over."),
+    max_dim: Optional[int] = MAX_DIM_QUERY,
+):
+    spec = registry.get_filter("bgrem")
+    # Imported here so the module still loads lazily (get_filter above has
+    # already imported it).
+    from services.enhance import bgrem
+
+    params = spec.parse_params(request.query_params)
+    stored = images.get(image_id)
+    full_dim = registry.resolve_max_dim([spec], max_dim)
+    img, _ = _at_size(stored, stored.source_key, full_dim)
+
+    hints_png = await hints.read() if hints is not None else None
+    # One refinement at a time per handle: each resumes from the last one's state.
+    async with stored.lock:
+        state = None if reset else stored.extras.get("bgrem")
+        result, state = await run_task(
+            [spec], bgrem.refine, img, full_dim, params["padding_percent"], state, hints_png
+        )
+        images.set_extra(stored, "bgrem", state)
+    return _respond(result, spec.media_type)
+
+
+# =================================
+# Batch Endpoint
+# =================================
+# Applies one filter to many images in a single request, e.g. a whole album:
+# POST /api/batch/auto_enhance with several `files` and/or a zip `archive`.
+# Results are streamed back as they finish, as a zip (with a manifest.json
+# listing failures) or as multipart/mixed.
+@router.post("/batch/{filter_name}")
+async def apply_filter_batch(
+    filter_name: str,
+    request: Request,
+    files: Optional[List[UploadFile]] = File(None, description="Images to process."),
+    archive: Optional[UploadFile] = File(None, description="A zip of images to process."),
+    container: Literal["zip", "multipart"] = Query("zip", description="How results are packed."),
+    max_dim: Optional[int] = MAX_DIM_QUERY,
+    format: Optional[Literal["jpeg", "png", "webp"]] = FORMAT_QUERY,
+    quality: Optional[int] = QUALITY_QUERY,
+    compression: Optional[int] = COMPRESSION_QUERY,
+):
+    spec = registry.get_filter(filter_name)
+    params = spec.parse_params(request.query_params)
+    check_room([spec])
+    sources = batch.BatchSources(files, archive)
+    full_dim = registry.resolve_max_dim([spec], max_dim)
+    encoding = _output_options(request, format, quality, compression).encoding_for(spec.format_for(params))
+    results = batch.run_batch(spec, params, sources, full_dim, encoding)
+
+    if container == "zip":
+        return StreamingResponse(
+            batch.zip_stream(results),
+            media_type="application/zip",
+            headers={"Content-Disposition": f'attachment; filename="{spec.name}.zip"'},
+        )
+    boundary = batch.multipart_boundary()
+    return StreamingResponse(
+        batch.multipart_stream(results, boundary),
+        media_type=f"multipart/mixed; boundary={boundary}",
+    )
+
+
+# =================================
+# Fanout Endpoint
+# =================================
+# Renders one image through many filters at thumbnail size, e.g. for a filter
+# picker: the image is uploaded and decoded once, and every filter runs
+# concurrently. Results come back as a zip, multipart/mixed, or a single
+# sprite sheet whose layout is in the X-Sprite-Layout header.
+@router.post("/fanout")
+async def apply_fanout(
+    request: Request,
+    file: Optional[UploadFile] = File(None),
+    filters: str = Form(..., description='JSON list of filter names or steps, '
+                                         'e.g. ["sketch", {"filter": "dot", "params": {"mode": "cmyk"}}]'),
+    image_id: Optional[str] = IMAGE_ID_QUERY,
+    size: int = Query(fanout.THUMBNAIL_DIM, ge=16, le=1024, description="Long edge of the thumbnails."),
+    container: Literal["zip", "multipart", "sprite"] = Query("zip", description="How results are packed."),
+    columns: Optional[int] = Query(None, ge=1, le=registry.MAX_FANOUT_FILTERS,
+                                   description="Thumbnails per row of the sprite sheet."),
+    format: Optional[Literal["jpeg", "png", "webp"]] = FORMAT_QUERY,
+    quality: Optional[int] = QUALITY_QUERY,
+    compression: Optional[int] = COMPRESSION_QUERY,
+):
+    steps = registry.parse_fanout(filters)
+    if container == "sprite":
+        registry.reject_text_output(steps, ("body", "filters"), "Text output cannot go on a sprite sheet")
+    for spec, _ in steps:
+        check_room([spec])
+    source, key = await _read_source(file, image_id)
+    if isinstance(source, StoredImage):
+        img, key = _at_size(source, key, size)
+    else:
+        img = await run_light(decode_image, source, size)
+
+    options = _output_options(request, format, quality, compression)
+    if container == "sprite":
+        encoded, encoding, layout = await fanout.render_sprite_sheet(steps, img, columns, options)
+        headers = {"X-Sprite-Layout": json.dumps(layout, separators=(",", ":")), "Vary": "Accept"}
+        return _respond(encoded, encoding.media_type, headers)
+
+    results = fanout.run_fanout(steps, img, key, size, options)
+    if container == "zip":
+        return StreamingResponse(
+            batch.zip_stream(results),
+            media_type="application/zip",
+            headers={"Content-Disposition": 'attachment; filename="fanout.zip"'},
+        )
+    boundary = batch.multipart_boundary()
+    return StreamingResponse(batch.multipart_stream(results, boundary),
+                             media_type=f"multipart/mixed; boundary={boundary}")
+
+
+# =================================
+# Generic Filter Endpoint
+# =================================
+# Every module in services/filters and services/enhance that declares a SPEC is
+# served here, e.g. POST /api/denoise?strength=10. Query parameters are
+# validated against the filter's params model.
+@router.post("/{filter_name}")
+async def apply_filter(
+    filter_name: str,
+    request: Request,
+    file: Optional[UploadFile] = File(None),
+    image_id: Optional[str] = IMAGE_ID_QUERY,
+    max_dim: Optional[int] = MAX_DIM_QUERY,
+    preview: bool = PREVIEW_QUERY,
+    full_render: bool = FULL_RENDER_QUERY,
+    format: Optional[Literal["jpeg", "png", "webp"]] = FORMAT_QUERY,
+    quality: Optional[int] = QUALITY_QUERY,
+    compression: Optional[int] = COMPRESSION_QUERY,
+):
+    spec = registry.get_filter(filter_name)
+    params = spec.parse_params(request.query_params)
+    source, key = await _read_source(file, image_id)
+    options = _output_options(request, format, quality, compression)
+    return await _render([(spec, params)], source, key, max_dim, preview, full_render, options)
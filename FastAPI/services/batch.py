@@ -0,0 +1,276 @@
+import asyncio
+import json
+import logging
+import secrets
+import zipfile
+import zlib
+from pathlib import PurePosixPath
+from typing import Optional
+from urllib.parse import quote
+
+from fastapi import HTTPException
+from fastapi.exceptions import RequestValidationError
+from services import registry
+from services.encoding import default_encoding
+from services.executor import pool_for, run_pipeline
+from services.utils import env_int
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on the images in one batch request.
+MAX_BATCH_FILES = env_int("SHARPIFY_MAX_BATCH_FILES", 1000)
+
+# Zip entries larger than this once decompressed are skipped with 413
+# rather than inflated into memory.
+MAX_ENTRY_BYTES = env_int("SHARPIFY_MAX_BATCH_ENTRY_BYTES", 64 * 1024 * 1024)
+
+
+class BatchSources:
+    """
+    The images of a batch request: uploaded files first, then the entries
+    of an uploaded zip archive. Contents are read one at a time as the batch
+    needs them, so at most the images in flight are held in memory.
+    """
+
+    def __init__(self, files: list, archive=None):
+        self.files = list(files or [])
+        self.archive = None
+        self.entries = []
+        if archive is not None:
+            try:
+                self.archive = zipfile.ZipFile(archive.file)
+            except zipfile.BadZipFile:
+                raise HTTPException(status_code=400, detail="The archive is not a valid zip file")
+            self.entries = [info for info in self.archive.infolist() if _is_image_entry(info)]
+
+        count = len(self.files) + len(self.entries)
+        if not 1 <= count <= MAX_BATCH_FILES:
+            raise RequestValidationError([{
+                "type": "value_error",
+                "loc": ("body", "files"),
+                "msg": f"A batch needs between 1 and {MAX_BATCH_FILES} images",
+                "input": count,
+            }])
+
+    async def __aiter__(self):
+        """
+        Yields (name, contents, error) triples. For a zip entry that is too
+        large or cannot be read (corrupt, encrypted or compressed with an
+        unsupported method), contents is None and error the HTTPException
+        to report for it; the other entries are still read.
+        """
+        for i, upload in enumerate(self.files):
+            yield upload.filename or f"image-{i}", await upload.read(), None
+        for info in self.entries:
+            if info.file_size > MAX_ENTRY_BYTES:
+                yield info.filename, None, HTTPException(status_code=413, detail="Entry is too large")
+                continue
+            try:
+                contents = await asyncio.to_thread(self.archive.read, info)
+            except RuntimeError:
+                # zipfile's error for entries that need a password.
+                yield info.filename, None, HTTPException(status_code=400, detail="Entry is encrypted")
+                continue
+            except NotImplementedError:
+                yield info.filename, None, HTTPException(
+                    status_code=400, detail="Entry uses an unsupported compression method")
+                continue
+            except (zipfile.BadZipFile, zlib.error, EOFError) as e:
+                yield info.filename, None, HTTPException(status_code=400, detail=f"Entry is corrupt: {e}")
+                continue
+            yield info.filename, contents, None
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+
+
+def _is_image_entry(info: zipfile.ZipInfo) -> bool:
+    path = PurePosixPath(info.filename)
+    hidden = any(part.startswith(".") or part == "__MACOSX" for part in path.parts)
+    return not info.is_dir() and not hidden
+
+
+def window_for(specs: list) -> int:
+    """
+    How many jobs for `specs` to keep in flight: one per worker of the pools
+    they run on, capped by their max_pending. That keeps every core busy
+    without filling the queue other requests wait in.
+    """
+    pools = {id(pool): pool for pool in map(pool_for, specs)}
+    window = sum(pool.workers for pool in pools.values())
+    limits = [spec.max_pending for spec in specs if spec.max_pending is not None]
+    return max(1, min([window, *limits]))
+
+
+async def item(name, format: str, work):
+    """
+    Awaits `work` for one item of a batch and returns (name, format, result,
+    error), where error is the HTTPException that stopped it, if any. `name`
+    identifies the item to the caller.
+    """
+    try:
+        return name, format, await work, None
+    except HTTPException as e:
+        return name, format, None, e
+    except Exception:
+        logger.exception("Batch item %r failed", name)
+        return name, format, None, HTTPException(status_code=500, detail="Internal error")
+
+
+async def as_finished(jobs, window: int):
+    """
+    Runs the coroutines from the (async) iterable `jobs` with at most
+    `window` of them at a time, and yields their results in the order they
+    finish. Later jobs are only taken from `jobs` when a slot frees up.
+    """
+    jobs = _aiter(jobs)
+    in_flight = set()
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(in_flight) < window:
+                try:
+                    in_flight.add(asyncio.create_task(await anext(jobs)))
+                except StopAsyncIteration:
+                    exhausted = True
+            if not in_flight:
+                break
+            done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        # Only left over when the client went away: their pool jobs still
+        # finish, but nobody waits for them.
+        for task in in_flight:
+            task.cancel()
+
+
+async def _aiter(iterable):
+    if hasattr(iterable, "__aiter__"):
+        async for value in iterable:
+            yield value
+    else:
+        for value in iterable:
+            yield value
+
+
+async def run_batch(spec, params: dict, sources: BatchSources, max_dim: Optional[int] = None, encoding=None):
+    """
+    Applies one filter to every image of `sources` and yields the results in
+    the order they finish.
+
+    Each image is decoded, filtered and encoded on the worker pool through
+    run_pipeline(), so results are cached like single requests. Images wait
+    for room on the pool rather than failing with 503; the request as a
+    whole is meant to be turned away up front with executor.check_room().
+
+    Yields:
+        (name, format, result, error): see item(). One failed image does not
+        stop the batch.
+    """
+    encoding = encoding or default_encoding(spec, params)
+    format = encoding.format
+
+    async def fail(error: HTTPException):
+        raise error
+
+    async def jobs():
+        async for name, contents, error in sources:
+            if error is not None:
+                yield item(name, format, fail(error))
+            else:
+                yield item(name, format, run_pipeline([(spec, params)], contents, None, max_dim, encoding, wait=True))
+
+    try:
+        async for result in as_finished(jobs(), window_for([spec])):
+            yield result
+    finally:
+        sources.close()
+
+
+def _output_name(name: str, format: str, used: set) -> str:
+    """The input's base name with the output extension, unique within the batch."""
+    stem = PurePosixPath(name.replace("\\", "/")).stem or "image"
+    candidate, n = f"{stem}{format}", 1
+    while candidate in used:
+        candidate, n = f"{stem}-{n}{format}", n + 1
+    used.add(candidate)
+    return candidate
+
+
+class _ChunkSink:
+    """A write-only file for zipfile that collects what it writes until taken."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data) -> int:
+        self.chunks.append(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> list:
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+async def zip_stream(results):
+    """
+    Streams batch results as a zip archive, one entry per result as soon as
+    it finishes, then a manifest.json mapping inputs to outputs or errors.
+    """
+    sink = _ChunkSink()
+    archive = zipfile.ZipFile(sink, "w")
+    used, manifest = set(), []
+
+    async for name, format, result, error in results:
+        if error is not None:
+            manifest.append({"input": name, "status": error.status_code, "detail": str(error.detail)})
+            continue
+        output = _output_name(name, format, used)
+        # Images are already compressed; only text outputs are worth deflating.
+        compression = zipfile.ZIP_DEFLATED if format in registry.TEXT_FORMATS else zipfile.ZIP_STORED
+        archive.writestr(output, result, compress_type=compression)
+        manifest.append({"input": name, "output": output})
+        for chunk in sink.take():
+            yield chunk
+
+    archive.writestr("manifest.json", json.dumps(manifest, indent=2), compress_type=zipfile.ZIP_DEFLATED)
+    archive.close()
+    for chunk in sink.take():
+        yield chunk
+
+
+def multipart_boundary() -> str:
+    return secrets.token_hex(16)
+
+
+async def multipart_stream(results, boundary: str):
+    """
+    Streams batch results as multipart/mixed, one part per result as soon as
+    it finishes. Failed images become application/json parts with the status
+    code in an X-Status header.
+    """
+    used = set()
+    async for name, format, result, error in results:
+        if error is not None:
+            filename = name
+            content_type = "application/json"
+            body = json.dumps({"input": name, "detail": str(error.detail)}).encode()
+            status = error.status_code
+        else:
+            filename = _output_name(name, format, used)
+            content_type, body, status = registry.MEDIA_TYPES[format], result, 200
+        yield (
+            f"--{boundary}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Disposition: attachment; filename*=utf-8''{quote(filename)}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"X-Status: {status}\r\n\r\n"
+        ).encode()
+        yield body
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode()
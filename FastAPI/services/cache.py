@@ -0,0 +1,174 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from services.utils import env_int
+
+# Uploads at least this large are hashed in a worker thread (hashlib releases
+# the GIL for them); smaller ones take less time than the thread hop.
+ASYNC_DIGEST_BYTES = 256 * 1024
+
+
+def digest(contents: bytes) -> str:
+    return hashlib.blake2b(contents, digest_size=20).hexdigest()
+
+
+async def digest_async(contents: bytes) -> str:
+    """digest() without blocking the event loop on large uploads."""
+    if len(contents) < ASYNC_DIGEST_BYTES:
+        return digest(contents)
+    return await asyncio.to_thread(digest, contents)
+
+
+def make_key(source_key: str, steps: list, encoding: str) -> str:
+    """
+    Content-addressed key for a render.
+
+    Args:
+        source_key: Identifies the input pixels, e.g. digest() of the upload.
+        steps: (filter name, params) pairs in order. Params are the validated
+               keyword arguments, so omitted and explicit defaults hash alike.
+        encoding: Identifies the output encoding (encoding.Encoding.key).
+    """
+    h = hashlib.blake2b(digest_size=20)
+    h.update(source_key.encode())
+    h.update(json.dumps([list(step) for step in steps], sort_keys=True, default=str).encode())
+    h.update(encoding.encode())
+    return h.hexdigest()
+
+
+class MemoryCache:
+    """An LRU of encoded results bounded by total size in bytes."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+
+    def get(self, key: str):
+        data = self._entries.get(key)
+        if data is not None:
+            self._entries.move_to_end(key)
+        return data
+
+    def put(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self._entries[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+
+class DiskCache:
+    """
+    Encoded results stored as one file per key, evicting the least recently
+    used files once the directory grows past `max_bytes`.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.size = sum(path.stat().st_size for path in self.directory.glob("*.bin"))
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.bin"
+
+    def get(self, key: str):
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return None
+        # mtime doubles as the last-access time for eviction.
+        os.utime(path)
+        return data
+
+    def put(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        if path.exists():
+            os.utime(path)
+            return
+        tmp = path.with_suffix(f".{os.getpid()}-{threading.get_ident()}.tmp")
+        tmp.write_bytes(data)
+        tmp.replace(path)
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        files = []
+        for path in self.directory.glob("*.bin"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+        self.size = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if self.size <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            self.size -= size
+
+
+class ResultCache:
+    """
+    Two-tier result cache: an in-memory LRU in front of an optional disk tier.
+
+    Disk reads and writes run in a worker thread so they never block the
+    event loop.
+    """
+
+    def __init__(self, memory: MemoryCache = None, disk: DiskCache = None):
+        self.memory = memory
+        self.disk = disk
+
+    @property
+    def enabled(self) -> bool:
+        return self.memory is not None or self.disk is not None
+
+    async def get(self, key: str):
+        if self.memory is not None:
+            data = self.memory.get(key)
+            if data is not None:
+                return data
+        if self.disk is not None:
+            data = await asyncio.to_thread(self.disk.get, key)
+            if data is not None:
+                if self.memory is not None:
+                    self.memory.put(key, data)
+                return data
+        return None
+
+    async def put(self, key: str, data: bytes):
+        if self.memory is not None:
+            self.memory.put(key, data)
+        if self.disk is not None:
+            await asyncio.to_thread(self.disk.put, key, data)
+
+
+def _from_env() -> ResultCache:
+    # SHARPIFY_CACHE_BYTES=0 disables the memory tier; the disk tier is only
+    # used when SHARPIFY_CACHE_DIR is set.
+    memory_bytes = env_int("SHARPIFY_CACHE_BYTES", 64 * 1024 * 1024)
+    disk_dir = os.environ.get("SHARPIFY_CACHE_DIR")
+    return ResultCache(
+        memory=MemoryCache(memory_bytes) if memory_bytes > 0 else None,
+        disk=DiskCache(disk_dir, env_int("SHARPIFY_CACHE_DISK_BYTES", 1024 * 1024 * 1024)) if disk_dir else None,
+    )
+
+
+results = _from_env()
@@ -0,0 +1,159 @@
+from dataclasses import dataclass
+from typing import Optional
+
+import cv2
+import numpy as np
+from services.registry import MEDIA_TYPES, TEXT_FORMATS
+from services.utils import encode_image, env_int
+
+# Values of ?format= and the extensions they select.
+FORMATS = {"jpeg": ".jpg", "png": ".png", "webp": ".webp"}
+
+# Image formats in the order they are offered when the Accept header rules
+# out a filter's default.
+_IMAGE_FORMATS = (".jpg", ".png", ".webp")
+
+# Defaults when the request gives no ?quality= or ?compression=. JPEGs are
+# always Huffman-optimized, which costs little and saves a few percent.
+JPEG_QUALITY = env_int("SHARPIFY_JPEG_QUALITY", 90)
+WEBP_QUALITY = env_int("SHARPIFY_WEBP_QUALITY", 80)
+
+# zlib level 0-9 for PNG: higher is smaller but slower to encode.
+PNG_COMPRESSION = env_int("SHARPIFY_PNG_COMPRESSION", 3)
+
+# JPEGs with a long edge of at least this many pixels are progressive, so
+# they display early on slow connections; small ones encode faster baseline.
+PROGRESSIVE_MIN_DIM = env_int("SHARPIFY_PROGRESSIVE_MIN_DIM", 1024)
+
+# Transparent areas become this colour in formats without alpha.
+MATTE_COLOR = (255, 255, 255)
+
+
+@dataclass(frozen=True)
+class Encoding:
+    """
+    A fully resolved way of encoding a result. Text outputs (see
+    registry.TEXT_FORMATS) only use `format`.
+
+    Args:
+        format: The extension: ".jpg", ".png", ".webp" or a text format.
+        quality: 1-100 for JPEG and lossy WebP.
+        compression: zlib level 0-9 for PNG.
+        lossless: Lossless WebP, for filters whose default is PNG.
+    """
+    format: str = ".jpg"
+    quality: Optional[int] = None
+    compression: Optional[int] = None
+    lossless: bool = False
+
+    @property
+    def media_type(self) -> str:
+        return MEDIA_TYPES[self.format]
+
+    @property
+    def key(self) -> str:
+        """Identifies the encoding in result cache keys."""
+        if self.format in TEXT_FORMATS:
+            return self.format
+        return f"{self.format}:{self.quality}:{self.compression}:{int(self.lossless)}"
+
+    def encode(self, img: np.ndarray) -> np.ndarray:
+        """Encodes an image; see utils.encode_image()."""
+        if self.format == ".jpg":
+            if img.ndim == 3 and img.shape[2] == 4:
+                img = _flatten(img)
+            params = [cv2.IMWRITE_JPEG_QUALITY, self.quality, cv2.IMWRITE_JPEG_OPTIMIZE, 1]
+            if max(img.shape[:2]) >= PROGRESSIVE_MIN_DIM:
+                params += [cv2.IMWRITE_JPEG_PROGRESSIVE, 1]
+        elif self.format == ".png":
+            params = [cv2.IMWRITE_PNG_COMPRESSION, self.compression]
+        else:
+            # OpenCV switches WebP to lossless for qualities above 100.
+            params = [cv2.IMWRITE_WEBP_QUALITY, 101 if self.lossless else self.quality]
+        return encode_image(img, self.format, params)
+
+
+def _flatten(img: np.ndarray) -> np.ndarray:
+    """Composites a BGRA image over MATTE_COLOR."""
+    bgr, alpha = img[:, :, :3], cv2.merge([img[:, :, 3]] * 3)
+    matte = np.full_like(bgr, MATTE_COLOR)
+    return cv2.add(cv2.multiply(bgr, alpha, scale=1.0 / 255),
+                   cv2.multiply(matte, 255 - alpha, scale=1.0 / 255))
+
+
+def _parse_accept(header: Optional[str]) -> Optional[dict]:
+    """Maps media ranges of an Accept header to their q-values; None if absent."""
+    if not header:
+        return None
+    ranges = {}
+    for part in header.split(","):
+        media_range, *params = [piece.strip() for piece in part.split(";")]
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if media_range:
+            ranges[media_range.lower()] = q
+    return ranges
+
+
+@dataclass(frozen=True)
+class OutputOptions:
+    """
+    What a request asks for: ?format=, ?quality=, ?compression= and the
+    Accept header. Resolved per result with encoding_for(), since the
+    default differs per filter.
+    """
+    format: Optional[str] = None
+    quality: Optional[int] = None
+    compression: Optional[int] = None
+    accept: Optional[str] = None
+
+    def _q(self, format: str) -> float:
+        ranges = _parse_accept(self.accept)
+        if ranges is None:
+            return 1.0
+        media_type = MEDIA_TYPES[format]
+        for media_range in (media_type, media_type.split("/")[0] + "/*", "*/*"):
+            if media_range in ranges:
+                return ranges[media_range]
+        return 0.0
+
+    def _choose(self, default: str) -> str:
+        if self.format is not None:
+            return FORMATS[self.format]
+        ranges = _parse_accept(self.accept) or {}
+        # WebP is only picked when a client names it: it is the smallest
+        # format, but much slower to encode than JPEG or PNG.
+        if ranges.get("image/webp", 0) > 0 and ranges["image/webp"] >= self._q(default):
+            return ".webp"
+        if self._q(default) > 0:
+            return default
+        acceptable = [format for format in _IMAGE_FORMATS if self._q(format) > 0]
+        return max(acceptable, key=self._q) if acceptable else default
+
+    def encoding_for(self, default: str) -> Encoding:
+        """
+        The encoding for a result whose filter defaults to the format
+        `default`. Filters defaulting to PNG (line art, flat colours) get
+        lossless WebP when WebP is chosen without a ?quality=.
+        """
+        if default in TEXT_FORMATS:
+            return Encoding(default)
+        format = self._choose(default)
+        if format == ".jpg":
+            return Encoding(format, quality=self.quality or JPEG_QUALITY)
+        if format == ".png":
+            return Encoding(format, compression=PNG_COMPRESSION if self.compression is None else self.compression)
+        if self.quality is None and default == ".png":
+            return Encoding(format, lossless=True)
+        return Encoding(format, quality=self.quality or WEBP_QUALITY)
+
+
+def default_encoding(spec, params: dict) -> Encoding:
+    """The encoding of a request that expresses no preference."""
+    return OutputOptions().encoding_for(spec.format_for(params))
@@ -1,10 +1,11 @@
 # services/auto_brightness.py
 import cv2
 import numpy as np
-from fastapi import UploadFile
-from ..utils import read_image_from_upload, encode_image_to_bytes
+from pydantic import BaseModel, Field
+from ..lut import LEVELS, to_table
+from ..registry import FilterSpec
 
-async def adjust_brightness_to_target(img_array: np.ndarray, target_avg_intensity: int = 128) -> np.ndarray:
+def adjust_brightness_to_target(img_array: np.ndarray, target_avg_intensity: int = 128) -> np.ndarray:
     """
     Adjusts the image brightness so its average intensity in the V channel (HSV)
     approaches target_avg_intensity.
@@ -19,7 +20,7 @@ async def adjust_brightness_to_target(img_array: np.ndarray, target_avg_intensit
         # If image is all black (or V channel is all 0), only brighten if target is > 0
         if target_avg_intensity > 0:
             # Add a fixed small amount or target_avg_intensity if it's small
-            v_new = np.clip(v.astype(np.int16) + target_avg_intensity, 0, 255).astype(np.uint8)
+            v_new = cv2.LUT(v, to_table(LEVELS + target_avg_intensity))
         else:
             v_new = v # No change
     else:
@@ -28,16 +29,19 @@ async def adjust_brightness_to_target(img_array: np.ndarray, target_avg_intensit
         # so new_v = v * (target_avg_intensity / current_avg_v)
         scale = target_avg_intensity / current_avg_v
         
-        # Apply scaling and clip to 0-255
-        v_scaled_float = v.astype(float) * scale
-        v_new = np.clip(v_scaled_float, 0, 255).astype(np.uint8)
+        # Apply scaling and clip to 0-255; the table depends on this image's
+        # mean, so it is built per call.
+        v_new = cv2.LUT(v, to_table(LEVELS * scale, rounding=False))
 
     final_hsv = cv2.merge((h, s, v_new))
     adjusted_img = cv2.cvtColor(final_hsv, cv2.COLOR_HSV2BGR)
     
     return adjusted_img
 
-async def process(file: UploadFile, target_intensity: int = 128):
-    img_array = await read_image_from_upload(file)
-    processed_img = await adjust_brightness_to_target(img_array, target_intensity)
-    return encode_image_to_bytes(processed_img)
\ No newline at end of file
+
+class AutoBrightnessParams(BaseModel):
+    target_avg_intensity: int = Field(128, ge=0, le=255, alias="target_intensity",
+                                      description="Target average brightness (V channel).")
+
+
+SPEC = FilterSpec(name="auto_brightness", func=adjust_brightness_to_target, params=AutoBrightnessParams)
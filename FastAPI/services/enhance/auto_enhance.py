@@ -1,10 +1,9 @@
 # services/auto_enhance.py
 import cv2
 import numpy as np
-from fastapi import UploadFile
-from ..utils import read_image_from_upload, encode_image_to_bytes
+from ..registry import FilterSpec
 
-async def auto_enhance_image(img_array: np.ndarray):
+def auto_enhance_image(img_array: np.ndarray):
     """
     Applies Contrast Limited Adaptive Histogram Equalization (CLAHE)
     to LAB color space for color images.
@@ -23,7 +22,5 @@ async def auto_enhance_image(img_array: np.ndarray):
 
     return enhanced_bgr_img
 
-async def process(file: UploadFile):
-    img_array = await read_image_from_upload(file)
-    processed_img = await auto_enhance_image(img_array)
-    return encode_image_to_bytes(processed_img)
\ No newline at end of file
+
+SPEC = FilterSpec(name="auto_enhance", func=auto_enhance_image)
@@ -1,69 +1,225 @@
 import cv2
 import numpy as np
-from fastapi import UploadFile
-from services.utils import read_image_from_upload, encode_image_to_bytes
+from dataclasses import dataclass
+from typing import Optional
+from pydantic import BaseModel, Field
+from services.registry import FilterSpec
+from services.utils import ImageDecodeError, encode_image, resize_to_fit
 
-async def process(file: UploadFile, padding_percent: int = 5):
+# Long edge of the first, whole-image GrabCut pass. Smaller sizes lose thin
+# structures such as fur and make the result depend more on initialisation.
+COARSE_DIM = 384
+
+# Long edge of the finest refinement pass; the alpha matte is upsampled
+# from this level to full size.
+REFINE_DIM = 1024
+
+COARSE_ITERATIONS = 5
+
+# GrabCut iterations when a session resumes with new hints.
+RESUME_ITERATIONS = 2
+
+# Half-width in pixels of the uncertain band re-segmented at each finer level.
+BAND_RADIUS = 4
+
+# Guided filter radius (at the finest level) and regularization, for
+# intensities scaled to 0-1.
+GUIDE_RADIUS = 4
+GUIDE_EPS = 1e-3
+
+# Hint value for pixels the user has not marked.
+NO_HINT = 255
+
+
+@dataclass
+class Segmentation:
+    """
+    GrabCut state kept between calls of refine(), so a correction resumes
+    from the previous result instead of starting from scratch.
+    """
+    size: tuple  # (width, height) of the finest level
+    mask: np.ndarray  # GrabCut labels at the coarse level
+    bgd_model: np.ndarray
+    fgd_model: np.ndarray
+    hints: np.ndarray  # Accumulated hints at the finest level: GC_FGD, GC_BGD or NO_HINT
+
+    @property
+    def nbytes(self) -> int:
+        return self.mask.nbytes + self.bgd_model.nbytes + self.fgd_model.nbytes + self.hints.nbytes
+
+
+def _level_dims(long_edge: int) -> list:
+    """Long edges of the pyramid levels, coarsest first, doubling up to REFINE_DIM."""
+    dims = [min(COARSE_DIM, long_edge)]
+    while dims[-1] < min(REFINE_DIM, long_edge):
+        dims.append(min(dims[-1] * 2, REFINE_DIM, long_edge))
+    return dims
+
+
+def _apply_hints(mask: np.ndarray, hints: Optional[np.ndarray]):
+    if hints is None:
+        return
+    hints = cv2.resize(hints, (mask.shape[1], mask.shape[0]), interpolation=cv2.INTER_NEAREST)
+    marked = hints != NO_HINT
+    mask[marked] = hints[marked]
+
+
+def _refine_band(img: np.ndarray, labels: np.ndarray, bgd_model, fgd_model, hints) -> np.ndarray:
+    """
+    Upsamples coarser GrabCut labels to `img` and re-segments only the
+    uncertain band around the boundary; everything else is fixed.
+    """
+    height, width = img.shape[:2]
+    labels = cv2.resize(labels, (width, height), interpolation=cv2.INTER_NEAREST)
+    # GC_FGD and GC_PR_FGD are the odd labels.
+    fg = labels & 1
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * BAND_RADIUS + 1,) * 2)
+    band = (cv2.dilate(fg, kernel) != cv2.erode(fg, kernel)).view(np.uint8)
+    # Definite outside the band, probable inside it.
+    mask = fg + 2 * band
+    _apply_hints(mask, hints)
+
+    x, y, w, h = cv2.boundingRect(band)
+    if w and h:
+        # The model is frozen: it was learned on the whole image at the coarse level.
+        crop = (slice(y, y + h), slice(x, x + w))
+        region = np.ascontiguousarray(mask[crop])
+        cv2.grabCut(np.ascontiguousarray(img[crop]), region, None, bgd_model.copy(), fgd_model.copy(),
+                    1, cv2.GC_EVAL_FREEZE_MODEL)
+        mask[crop] = region
+    return mask
+
+
+def _guided_alpha(guide: np.ndarray, labels: np.ndarray, img: np.ndarray) -> np.ndarray:
+    """
+    Edge-aware alpha matte: a guided filter fitted at the finest level, with
+    its linear coefficients upsampled and applied to the full-size image.
+    """
+    def box(x):
+        return cv2.boxFilter(x, -1, (2 * GUIDE_RADIUS + 1,) * 2)
+
+    small = cv2.cvtColor(guide, cv2.COLOR_BGR2GRAY).astype(np.float32) / 255
+    p = (labels & 1).astype(np.float32)
+    mean_i, mean_p = box(small), box(p)
+    var_i = box(small * small) - mean_i * mean_i
+    a = (box(small * p) - mean_i * mean_p) / (var_i + GUIDE_EPS)
+    b = mean_p - a * mean_i
+
+    height, width = img.shape[:2]
+    a = cv2.resize(box(a), (width, height), interpolation=cv2.INTER_LINEAR)
+    b = cv2.resize(box(b), (width, height), interpolation=cv2.INTER_LINEAR)
+    full = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY).astype(np.float32) / 255
+    return cv2.convertScaleAbs(np.clip(a * full + b, 0, 1), alpha=255)
+
+
+def segment(img: np.ndarray, padding_percent: int = 5, state: Segmentation = None, hints: np.ndarray = None):
+    """
+    Multi-resolution GrabCut: a whole-image pass at COARSE_DIM, then passes
+    on the boundary band only at each finer level up to REFINE_DIM, then a
+    guided-filter matte at full size.
+
+    Args:
+        img: The BGR image.
+        padding_percent: Padding of the initial subject rectangle.
+        state: A previous Segmentation of the same image to resume from.
+        hints: Optional labels at the size of `img`: GC_FGD to keep, GC_BGD
+               to remove, NO_HINT elsewhere. Added to the state's hints.
+
+    Returns:
+        (alpha, state): the uint8 alpha matte and the state to resume from.
+    """
+    levels = [resize_to_fit(img, dim) for dim in _level_dims(max(img.shape[:2]))]
+    finest_size = (levels[-1].shape[1], levels[-1].shape[0])
+    if state is not None and state.size != finest_size:
+        state = None
+
+    all_hints = state.hints.copy() if state is not None else np.full(finest_size[::-1], NO_HINT, np.uint8)
+    if hints is not None:
+        hints = cv2.resize(hints, finest_size, interpolation=cv2.INTER_NEAREST)
+        marked = hints != NO_HINT
+        all_hints[marked] = hints[marked]
+
+    coarse = levels[0]
+    if state is None:
+        # The rectangle GC_INIT_WITH_RECT would use, with hints on top.
+        height, width = coarse.shape[:2]
+        padding_x = max(1, int(width * (padding_percent / 100.0)))
+        padding_y = max(1, int(height * (padding_percent / 100.0)))
+        mask = np.full((height, width), cv2.GC_BGD, np.uint8)
+        mask[padding_y:height - padding_y, padding_x:width - padding_x] = cv2.GC_PR_FGD
+        bgd_model = np.zeros((1, 65), np.float64)
+        fgd_model = np.zeros((1, 65), np.float64)
+        _apply_hints(mask, all_hints)
+        # GrabCut seeds its colour models with k-means on OpenCV's RNG; a fixed
+        # seed makes the result reproducible (and so cacheable).
+        cv2.setRNGSeed(0)
+        cv2.grabCut(coarse, mask, None, bgd_model, fgd_model, COARSE_ITERATIONS, cv2.GC_INIT_WITH_MASK)
+    else:
+        mask, bgd_model, fgd_model = state.mask.copy(), state.bgd_model.copy(), state.fgd_model.copy()
+        _apply_hints(mask, all_hints)
+        cv2.grabCut(coarse, mask, None, bgd_model, fgd_model, RESUME_ITERATIONS, cv2.GC_EVAL)
+
+    state = Segmentation(finest_size, mask, bgd_model, fgd_model, all_hints)
+    labels = mask
+    for level in levels[1:]:
+        labels = _refine_band(level, labels, bgd_model, fgd_model, all_hints)
+    return _guided_alpha(levels[-1], labels, img), state
+
+
+def _read_hints(contents: bytes, shape: tuple) -> np.ndarray:
     """
-    Removes the background from an image using a performance-optimized
-    GrabCut algorithm.
+    Decodes a hints image: opaque white pixels mark what to keep, opaque
+    black pixels what to remove; transparent or grey pixels are left to
+    GrabCut.
+    """
+    hints_img = cv2.imdecode(np.frombuffer(contents, np.uint8), cv2.IMREAD_UNCHANGED)
+    if hints_img is None:
+        raise ImageDecodeError("Could not decode the hints image")
+    if hints_img.ndim == 2:
+        gray, opaque = hints_img, np.ones(hints_img.shape, bool)
+    else:
+        gray = cv2.cvtColor(hints_img[:, :, :3], cv2.COLOR_BGR2GRAY)
+        opaque = hints_img[:, :, 3] >= 128 if hints_img.shape[2] == 4 else np.ones(gray.shape, bool)
+    hints = np.full(gray.shape, NO_HINT, np.uint8)
+    hints[opaque & (gray >= 192)] = cv2.GC_FGD
+    hints[opaque & (gray < 64)] = cv2.GC_BGD
+    return cv2.resize(hints, (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST)
+
 
-    This function processes a downscaled version of the image for speed and
-    applies the resulting mask to the original for high-quality output.
-    The output is a PNG with a transparent background.
+def remove_background(img: np.ndarray, padding_percent: int = 5) -> np.ndarray:
+    """
+    Removes the background from an image using multi-resolution GrabCut
+    (see segment()). The output is a PNG with a transparent background.
 
     Args:
-        file: The uploaded image file.
+        img: The BGR image.
         padding_percent: The percentage of padding from the edge to define the
                          central rectangle containing the subject.
 
     Returns:
-        A PNG image as bytes with the background removed (made transparent).
+        A BGRA image with the background removed (made transparent).
     """
-    img = await read_image_from_upload(file)
-    if img is None:
-        return None
-
-    original_shape = img.shape[:2]
-
-    # --- PERFORMANCE OPTIMIZATION ---
-    # Downscale the image to a manageable size for fast processing.
-    # A max dimension of 600px is a good balance of speed and accuracy.
-    MAX_DIMENSION = 600
-    scale_ratio = MAX_DIMENSION / max(original_shape)
-    
-    # If the image is already small, don't upscale it.
-    if scale_ratio > 1:
-        scale_ratio = 1
-        
-    processing_shape = (int(original_shape[1] * scale_ratio), int(original_shape[0] * scale_ratio))
-    small_img = cv2.resize(img, processing_shape, interpolation=cv2.INTER_AREA)
-
-    # 1. Initialize a mask and models for GrabCut.
-    mask = np.zeros(small_img.shape[:2], np.uint8)
-    bgdModel = np.zeros((1, 65), np.float64)
-    fgdModel = np.zeros((1, 65), np.float64)
-
-    # 2. Define the central rectangle on the SMALL image.
-    height, width, _ = small_img.shape
-    padding_x = int(width * (padding_percent / 100.0))
-    padding_y = int(height * (padding_percent / 100.0))
-    rect = (padding_x, padding_y, width - 2 * padding_x, height - 2 * padding_y)
-
-    # 3. Run GrabCut on the SMALL image. This will be very fast.
-    cv2.grabCut(small_img, mask, rect, bgdModel, fgdModel, 5, cv2.GC_INIT_WITH_RECT)
-
-    # 4. Create the final mask from the small result.
-    small_mask = np.where((mask == cv2.GC_PR_FGD) | (mask == cv2.GC_FGD), 255, 0).astype('uint8')
-
-    # 5. --- UPSCALE THE MASK ---
-    # Resize the low-resolution mask back to the original image dimensions.
-    # Use INTER_NEAREST to avoid blurry, semi-transparent edges.
-    final_mask = cv2.resize(small_mask, (original_shape[1], original_shape[0]), interpolation=cv2.INTER_NEAREST)
-
-    # 6. Apply the full-resolution mask to the original, high-resolution image.
-    bgra_img = cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
-    bgra_img[:, :, 3] = final_mask
-
-    # Return the result encoded as a PNG to preserve transparency.
-    return encode_image_to_bytes(bgra_img, '.png')
\ No newline at end of file
+    alpha, _ = segment(img, padding_percent)
+    return cv2.merge([*cv2.split(img), alpha])
+
+
+def refine(img: np.ndarray, max_dim: Optional[int], padding_percent: int,
+           state: Optional[Segmentation], hints_png: Optional[bytes]):
+    """
+    One step of an interactive session (POST /api/bgrem/refine).
+
+    Returns:
+        (png, state): the encoded BGRA result and the state for the next step.
+    """
+    img = resize_to_fit(img, max_dim)
+    hints = _read_hints(hints_png, img.shape[:2]) if hints_png else None
+    alpha, state = segment(img, padding_percent, state, hints)
+    return encode_image(cv2.merge([*cv2.split(img), alpha]), ".png"), state
+
+
+class BgremParams(BaseModel):
+    padding_percent: int = Field(5, ge=0, le=45, description="Padding from the edge around the subject rectangle.")
+
+
+# Encoded as PNG to preserve transparency.
+SPEC = FilterSpec(name="bgrem", func=remove_background, params=BgremParams, format=".png", cost="heavy")
@@ -1,34 +1,89 @@
 # services/denoise.py
 import cv2
 import numpy as np
-from fastapi import UploadFile
-from ..utils import read_image_from_upload, encode_image_to_bytes
+from typing import Literal
+from pydantic import BaseModel, Field
+from ..registry import FilterSpec
+from ..tiling import map_tiles
 
-async def denoise_image(img_array: np.ndarray, strength_h: int = 10):
+# Tiers by rising quality, with their measured single-core cost in
+# milliseconds per megapixel at the default strength. Inputs are capped at
+# 2048 px (about 3 MP), so even "quality" stays within the heavy timeout.
+TIER_BUDGET_MS_PER_MP = {
+    "fast": 50,        # Edge-preserving bilateral filter.
+    "balanced": 300,   # NLM on lightness only, chroma blurred at half size.
+    "quality": 2100,   # Full colour NLM.
+}
+
+# mode=auto uses the best tier whose load limit is not exceeded, with load
+# between 0 (idle) and 1 (requests are being rejected).
+AUTO_TIERS = (("quality", 0.25), ("balanced", 0.75))
+
+# Smaller NLM windows used by the balanced tier.
+BALANCED_TEMPLATE_WINDOW = 5
+BALANCED_SEARCH_WINDOW = 13
+
+def denoise_image(img_array: np.ndarray, strength_h: int = 10, mode: str = "quality",
+                  template_window_size: int = 7, search_window_size: int = 21):
     """
-    Applies Non-Local Means Denoising.
+    Applies Non-Local Means Denoising, or a cheaper approximation of it.
     h: Parameter regulating filter strength. Higher h value removes more noise
        but also removes image details. (Recommended values 5-30)
     hColor: Same as h, but for color components. Usually same as h.
+    mode: "fast", "balanced" or "quality" (see TIER_BUDGET_MS_PER_MP).
     templateWindowSize: Should be odd. (Recommended 7)
     searchWindowSize: Should be odd. (Recommended 21)
     """
-    # Parameters for fastNlMeansDenoisingColored
+    if mode == "fast":
+        # d=7 reaches 3 pixels out.
+        return map_tiles(lambda tile: cv2.bilateralFilter(tile, 7, strength_h * 3, 5), img_array, 3)
+
+    if mode == "balanced":
+        halo = BALANCED_SEARCH_WINDOW // 2 + BALANCED_TEMPLATE_WINDOW // 2
+        return map_tiles(lambda tile: _denoise_lightness(tile, strength_h), img_array, halo)
+
     # h and hColor are the same in this simplified version, controlled by strength_h
-    template_window_size = 7
-    search_window_size = 21
-
-    denoised_img = cv2.fastNlMeansDenoisingColored(
-        img_array,
-        None,
-        h=float(strength_h), # h (Luminance component)
-        hColor=float(strength_h), # hColor (Color components) - often same as h
-        templateWindowSize=template_window_size,
-        searchWindowSize=search_window_size
-    )
-    return denoised_img
-
-async def process(file: UploadFile, strength_h: int = 10):
-    img_array = await read_image_from_upload(file)
-    processed_img = await denoise_image(img_array, strength_h)
-    return encode_image_to_bytes(processed_img)
\ No newline at end of file
+    def denoise_tile(tile):
+        return cv2.fastNlMeansDenoisingColored(
+            tile,
+            None,
+            h=float(strength_h), # h (Luminance component)
+            hColor=float(strength_h), # hColor (Color components) - often same as h
+            templateWindowSize=template_window_size,
+            searchWindowSize=search_window_size
+        )
+
+    # Each pixel compares patches anywhere in its search window.
+    halo = search_window_size // 2 + template_window_size // 2
+    return map_tiles(denoise_tile, img_array, halo)
+
+def _denoise_lightness(img: np.ndarray, strength_h: int) -> np.ndarray:
+    l, a, b = cv2.split(cv2.cvtColor(img, cv2.COLOR_BGR2LAB))
+    l = cv2.fastNlMeansDenoising(l, None, h=float(strength_h),
+                                 templateWindowSize=BALANCED_TEMPLATE_WINDOW,
+                                 searchWindowSize=BALANCED_SEARCH_WINDOW)
+
+    # Chroma noise is low-frequency to the eye: blur it at half size.
+    height, width = l.shape
+    ab = cv2.resize(cv2.merge([a, b]), (max(1, width // 2), max(1, height // 2)), interpolation=cv2.INTER_AREA)
+    ab = cv2.resize(cv2.GaussianBlur(ab, (0, 0), 1.5), (width, height), interpolation=cv2.INTER_LINEAR)
+    return cv2.cvtColor(cv2.merge([l, ab]), cv2.COLOR_LAB2BGR)
+
+def pick_tier(params: dict, load: float) -> dict:
+    """Resolves mode=auto to a concrete tier for the current server load."""
+    if params.get("mode") != "auto":
+        return params
+    mode = next((mode for mode, max_load in AUTO_TIERS if load <= max_load), "fast")
+    return {**params, "mode": mode}
+
+
+class DenoiseParams(BaseModel):
+    strength_h: int = Field(10, ge=1, le=50, alias="strength",
+                            description="Denoising strength for NLM. Higher is stronger.")
+    mode: Literal["auto", "fast", "balanced", "quality"] = Field(
+        "auto", description="Quality/latency tier: fast (~50 ms/MP), balanced (~300 ms/MP) or "
+                            "quality (~2 s/MP). auto picks the best tier the current load allows.")
+
+
+SPEC = FilterSpec(name="denoise", func=denoise_image, params=DenoiseParams, cost="heavy", under_load=pick_tier,
+                  preview_params={"template_window_size": 5, "search_window_size": 11}, max_dim=2048, max_pending=4)
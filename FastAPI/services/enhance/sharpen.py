@@ -1,10 +1,10 @@
 # services/sharpen.py
 import cv2
 import numpy as np
-from fastapi import UploadFile
-from ..utils import read_image_from_upload, encode_image_to_bytes
+from pydantic import BaseModel, Field
+from ..registry import FilterSpec
 
-async def sharpen_image(img_array: np.ndarray, amount: float = 1.0):
+def sharpen_image(img_array: np.ndarray, amount: float = 1.0):
     """
     Sharpens the image using a sharpening kernel and blends it.
     Amount controls the blending: 0 = original, 1 = fully sharpened, >1 = oversharpened.
@@ -36,7 +36,9 @@ async def sharpen_image(img_array: np.ndarray, amount: float = 1.0):
 
     return final_image
 
-async def process(file: UploadFile, amount: float = 1.0):
-    img_array = await read_image_from_upload(file)
-    processed_img = await sharpen_image(img_array, amount)
-    return encode_image_to_bytes(processed_img)
\ No newline at end of file
+
+class SharpenParams(BaseModel):
+    amount: float = Field(1.0, ge=0.1, le=5.0, description="Amount of sharpening. 1.0 is a moderate sharpen.")
+
+
+SPEC = FilterSpec(name="sharpen", func=sharpen_image, params=SharpenParams)
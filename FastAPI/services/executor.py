@@ -0,0 +1,385 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from fastapi import HTTPException
+from services import cache, image_store, metrics, registry, tiling
+from services.encoding import default_encoding
+from services.image_store import build_variants
+from services.utils import ImageDecodeError, StageTimer, as_bgr, decode_image, env_int, resize_to_fit
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerPool:
+    """
+    A lazily created executor with a bound on how many jobs may wait for it.
+
+    Jobs beyond ``workers + max_queue`` are rejected with 503 instead of
+    queueing, so latency stays bounded under load; callers that would rather
+    wait, like the items of a batch, wait outside the pool until a job
+    finishes (see run_task). A process pool whose worker died (e.g.
+    OOM-killed) is replaced on the next job.
+    """
+
+    def __init__(self, kind: str, workers: int, max_queue: int, enabled: bool = True):
+        self.kind = kind
+        self.workers = max(1, workers)
+        self.max_queue = max(0, max_queue)
+        self.enabled = enabled
+        self.pending = 0
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            if self.kind == "process":
+                # "spawn" is safe to use from a multi-threaded server process.
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="sharpify"
+                )
+        return self._executor
+
+    @property
+    def available(self) -> bool:
+        """
+        Whether the executor can be started. Process pools need working
+        multiprocessing semaphores, which serverless platforms without
+        /dev/shm lack; a pool that fails to start is given up for good.
+        """
+        if self.enabled:
+            try:
+                self.executor
+            except (OSError, ImportError, NotImplementedError) as e:
+                logger.warning("Cannot start the %s pool (%s); using the thread pool instead", self.kind, e)
+                self.enabled = False
+        return self.enabled
+
+    @property
+    def is_full(self) -> bool:
+        return self.pending >= self.workers + self.max_queue
+
+    def submit(self, fn, *args) -> asyncio.Future:
+        """
+        Schedules `fn(*args)` and returns an awaitable future.
+
+        The job counts as pending until it actually finishes, even if the
+        caller stops waiting for it earlier.
+        """
+        loop = asyncio.get_running_loop()
+        executor = self.executor
+        try:
+            future = loop.run_in_executor(executor, functools.partial(fn, *args))
+        except BrokenProcessPool:
+            self._discard(executor)
+            executor = self.executor
+            future = loop.run_in_executor(executor, functools.partial(fn, *args))
+        self.pending += 1
+        future.add_done_callback(functools.partial(self._release, executor))
+        return future
+
+    def _release(self, executor, future):
+        self.pending -= 1
+        _wake_waiters()
+        if not future.cancelled():
+            # Mark the exception as retrieved for jobs nobody awaits anymore.
+            if isinstance(future.exception(), BrokenProcessPool):
+                self._discard(executor)
+
+    def _discard(self, executor):
+        """Drops a broken `executor` unless it was already replaced."""
+        if self._executor is executor:
+            logger.warning("A %s pool worker died; starting a new pool", self.kind)
+            self.shutdown()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+_CPU_COUNT = os.cpu_count() or 1
+
+thread_pool = WorkerPool(
+    "thread",
+    workers=env_int("SHARPIFY_THREAD_WORKERS", _CPU_COUNT),
+    max_queue=env_int("SHARPIFY_MAX_QUEUE", 32),
+)
+# Serverless platforms may not allow child processes; SHARPIFY_PROCESS_POOL=0
+# routes everything through the thread pool instead, as does a process pool
+# that fails to start (see WorkerPool.available).
+process_pool = WorkerPool(
+    "process",
+    workers=env_int("SHARPIFY_PROCESS_WORKERS", _CPU_COUNT),
+    max_queue=env_int("SHARPIFY_MAX_QUEUE", 32),
+    enabled=os.environ.get("SHARPIFY_PROCESS_POOL", "1") != "0",
+)
+
+_filter_pending = {}
+
+# Futures of run_task(wait=True) calls waiting for a pool or filter limit to
+# free up; all are woken whenever a job finishes and check again.
+_waiters = []
+
+
+def _filter_done(name: str):
+    _filter_pending[name] -= 1
+    _wake_waiters()
+
+
+def _wake_waiters():
+    waiters = _waiters[:]
+    _waiters.clear()
+    for waiter in waiters:
+        if not waiter.done():
+            waiter.set_result(None)
+
+
+def pool_for(spec) -> WorkerPool:
+    if spec.pool == "process" and process_pool.available:
+        return process_pool
+    return thread_pool
+
+
+def load(spec) -> float:
+    """
+    How busy the pool that would run `spec` is, from 0 (idle) to 1 (new work
+    is rejected), also counting the filter's own max_pending.
+    """
+    pool = pool_for(spec)
+    level = pool.pending / (pool.workers + pool.max_queue)
+    if spec.max_pending is not None:
+        level = max(level, _filter_pending.get(spec.name, 0) / spec.max_pending)
+    return min(1.0, level)
+
+
+def _task_pool(specs: list) -> WorkerPool:
+    return process_pool if any(pool_for(spec) is process_pool for spec in specs) else thread_pool
+
+
+def _has_room(pool: WorkerPool, specs: list) -> bool:
+    return not pool.is_full and all(
+        spec.max_pending is None or _filter_pending.get(spec.name, 0) < spec.max_pending for spec in specs
+    )
+
+
+def check_room(specs: list):
+    """
+    Raises 503 if a job for `specs` would be rejected right now. For requests
+    that queue up many jobs with run_task(wait=True), so they still fail fast
+    before they start streaming.
+    """
+    if not _has_room(_task_pool(specs), specs):
+        raise _busy(specs[0].name if len(specs) == 1 else "pipeline")
+
+
+def _busy(label: str = None):
+    if label is not None:
+        metrics.errors.inc(label, "503")
+    return HTTPException(
+        status_code=503,
+        detail="Server is busy, please retry shortly.",
+        headers={"Retry-After": "1"},
+    )
+
+
+def _render(steps: list, source, encoding, max_dim: int = None):
+    """Returns the encoded result and the StageTimer of the render."""
+    timer = StageTimer()
+    with timer.stage("decode"):
+        if isinstance(source, bytes):
+            img = decode_image(source, max_dim)
+        else:
+            img = resize_to_fit(source, max_dim)
+    timer.megapixels = img.shape[0] * img.shape[1] / 1e6
+    for i, (name, func, params) in enumerate(steps):
+        with timer.stage("filter", name):
+            if i:
+                # Steps may return grayscale or BGRA; the next one expects BGR.
+                img = as_bgr(img)
+            img = func(img, **params)
+    with timer.stage("encode"):
+        if isinstance(img, str):
+            # Text output (see registry.TEXT_FORMATS).
+            return img.encode("utf-8"), timer
+        return encoding.encode(img), timer
+
+
+async def run_pipeline(steps: list, source, source_key: str = None, max_dim: int = None, encoding=None,
+                       wait: bool = False):
+    """
+    Decodes `source` once, applies each step in order and encodes once.
+
+    Results are served from and stored in the result cache when every step
+    is cacheable (deterministic, or seeded).
+
+    Args:
+        steps: A list of (FilterSpec, params) pairs. The work runs on the
+               process pool if any step asks for it, counts against every
+               step's max_pending, and may take the sum of their time limits.
+               Steps with an `under_load` hook may have their params
+               adjusted to the current load first.
+        source: The raw uploaded image bytes, or an already decoded BGR image.
+        source_key: Identifies `source` for the result cache. Computed from
+                    the bytes when omitted; decoded images are only cached
+                    when one is given.
+        max_dim: Downscale the input so its long edge is at most this many
+                 pixels before the first step (see registry.resolve_max_dim).
+        encoding: An encoding.Encoding for the result. Defaults to the last
+                  step's format at the default quality.
+        wait: Wait for room on the pool instead of failing with 503 when it
+              is full (see run_task).
+
+    Returns:
+        The encoded result as a memoryview over the encoder's buffer, or
+        over the cached bytes, without copying either.
+    """
+    steps = [(spec, spec.under_load(params, load(spec)) if spec.under_load else params)
+             for spec, params in steps]
+    encoding = encoding or default_encoding(*steps[-1])
+    label = steps[0][0].name if len(steps) == 1 else "pipeline"
+    if source_key is None and isinstance(source, bytes) and cache.results.enabled:
+        source_key = await cache.digest_async(source)
+    key = result_key(steps, source, source_key, max_dim, encoding) if cache.results.enabled else None
+    if key is not None:
+        start = time.perf_counter()
+        data = await cache.results.get(key)
+        if data is not None:
+            metrics.cache_hits.inc(label)
+            metrics.server_timing("cache", time.perf_counter() - start, label)
+            return memoryview(data)
+
+    result, timer = await _compute(steps, source, encoding, max_dim, wait)
+    result = memoryview(result)
+    metrics.record_render(label, timer, len(result))
+    if key is not None:
+        await cache.results.put(key, result)
+    return result
+
+
+def result_key(steps: list, source, source_key: str = None, max_dim: int = None, encoding=None):
+    """The result cache key for a render, or None if it is not cacheable."""
+    if source_key is None and isinstance(source, bytes):
+        source_key = cache.digest(source)
+    if source_key is None or not all(spec.is_cacheable(params) for spec, params in steps):
+        return None
+    encoding = encoding or default_encoding(*steps[-1])
+    return cache.make_key(f"{source_key}@{max_dim}", [(spec.name, params) for spec, params in steps], encoding.key)
+
+
+async def _compute(steps: list, source, encoding, max_dim: int = None, wait: bool = False):
+    work = [(spec.name, spec.func, params) for spec, params in steps]
+    start = time.perf_counter()
+    result, timer = await run_task([spec for spec, _ in steps], _render, work, source, encoding, max_dim, wait=wait)
+    # Whatever the worker did not spend rendering was spent waiting for it.
+    timer.stages.insert(0, ("queue", None, max(0.0, time.perf_counter() - start - timer.total)))
+    return result, timer
+
+
+async def run_task(specs: list, fn, *args, wait: bool = False):
+    """
+    Runs `fn(*args)` on the pool the filters in `specs` need, under their
+    503 limits and combined time limit. For work that is more than a plain
+    render, e.g. a stateful endpoint; `fn` must be picklable.
+
+    With `wait`, a full pool or filter limit is waited out instead of
+    failing with 503: for the items of batch and fanout requests, which
+    are part of one request that was already admitted (see check_room).
+    The time limit only starts once the job is submitted.
+    """
+    names = {spec.name for spec in specs}
+    label = specs[0].name if len(specs) == 1 else "pipeline"
+
+    pool = _task_pool(specs)
+    while not _has_room(pool, specs):
+        if not wait:
+            raise _busy(label)
+        waiter = asyncio.get_running_loop().create_future()
+        _waiters.append(waiter)
+        await waiter
+
+    future = pool.submit(fn, *args)
+    for name in names:
+        _filter_pending[name] = _filter_pending.get(name, 0) + 1
+        future.add_done_callback(lambda _, name=name: _filter_done(name))
+    try:
+        # shield() keeps a timed-out job counted against the limits until it
+        # really finishes; worker threads cannot be interrupted.
+        timeout = sum(spec.time_limit for spec in specs)
+        return await asyncio.wait_for(asyncio.shield(future), timeout=timeout)
+    except asyncio.TimeoutError:
+        metrics.errors.inc(label, "504")
+        raise HTTPException(status_code=504, detail=f"'{label}' timed out")
+    except ImageDecodeError as e:
+        metrics.errors.inc(label, "400")
+        raise HTTPException(status_code=400, detail=str(e))
+    except BrokenProcessPool:
+        # A worker died mid-job, most likely OOM-killed; the pool has been
+        # dropped and the next job starts a new one (see WorkerPool).
+        raise _busy(label)
+    except HTTPException as e:
+        metrics.errors.inc(label, str(e.status_code))
+        raise
+    except Exception:
+        metrics.errors.inc(label, "500")
+        raise
+
+
+async def run_filter(spec, source, params: dict = None, source_key: str = None, max_dim: int = None):
+    """Applies a single filter; see run_pipeline()."""
+    return await run_pipeline([(spec, params or {})], source, source_key, max_dim)
+
+
+def _decode_variants(contents: bytes):
+    # Every render is capped at MAX_DIM, so pixels beyond it are never used;
+    # decoding to it keeps them out of the store (see decode_image).
+    return cache.digest(contents), build_variants(decode_image(contents, registry.MAX_DIM))
+
+
+async def run_light(fn, *args):
+    """
+    Runs a short job that is not a filter, e.g. decoding an upload or
+    composing a sprite sheet, on the thread pool.
+    """
+    if thread_pool.is_full:
+        raise _busy()
+    try:
+        return await thread_pool.submit(fn, *args)
+    except ImageDecodeError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+async def store_upload(contents: bytes):
+    """Hashes and decodes an upload on the thread pool and keeps it in the image store."""
+    key, variants = await run_light(_decode_variants, contents)
+    return image_store.images.put(key, variants)
+
+
+metrics.Gauge(
+    "sharpify_pool_pending",
+    "Jobs running or queued on each worker pool.",
+    ("pool",),
+    lambda: {(pool.kind,): pool.pending for pool in (thread_pool, process_pool)},
+)
+metrics.Gauge(
+    "sharpify_pool_capacity",
+    "Jobs each worker pool accepts before rejecting with 503.",
+    ("pool",),
+    lambda: {(pool.kind,): pool.workers + pool.max_queue for pool in (thread_pool, process_pool)},
+)
+
+
+def shutdown():
+    thread_pool.shutdown()
+    process_pool.shutdown()
+    tiling.shutdown()
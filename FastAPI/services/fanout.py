@@ -0,0 +1,112 @@
+import math
+
+import cv2
+import numpy as np
+from services import batch
+from services.encoding import OutputOptions
+from services.executor import load, run_light, run_pipeline, run_task
+
+# Default long edge of fanout thumbnails.
+THUMBNAIL_DIM = 256
+
+
+def run_fanout(steps: list, img: np.ndarray, source_key: str, size: int, options: OutputOptions = None):
+    """
+    Renders `img` (already at thumbnail size) through every step on its own,
+    with each filter's preview params, and yields the encoded results in the
+    order they finish. `options` are resolved per filter, so each keeps its
+    own default format. Filters wait for room on the pool rather than
+    failing with 503 (see executor.run_task).
+
+    Yields:
+        (filter name, format, result, error): see batch.item().
+    """
+    options = options or OutputOptions()
+    steps = [(spec, spec.with_preview(params)) for spec, params in steps]
+    encodings = [options.encoding_for(spec.format_for(params)) for spec, params in steps]
+    jobs = (
+        batch.item(spec.name, encoding.format,
+                   run_pipeline([(spec, params)], img, source_key, size, encoding, wait=True))
+        for (spec, params), encoding in zip(steps, encodings)
+    )
+    return batch.as_finished(jobs, batch.window_for([spec for spec, _ in steps]))
+
+
+def _thumbnail(func, params: dict, img: np.ndarray) -> np.ndarray:
+    return func(img, **params)
+
+
+def _compose(thumbnails: list, columns: int):
+    """
+    Lays `thumbnails` out left to right, top to bottom, in cells as large as
+    the largest one. Missing (failed) thumbnails leave their cell empty.
+
+    Returns:
+        (sheet, boxes): the sheet, with an alpha channel if any thumbnail has
+        one, and the (x, y, width, height) of every thumbnail.
+    """
+    present = [t for t in thumbnails if t is not None]
+    channels = 4 if any(t.ndim == 3 and t.shape[2] == 4 for t in present) else 3
+    cell_h = max((t.shape[0] for t in present), default=1)
+    cell_w = max((t.shape[1] for t in present), default=1)
+    rows = math.ceil(len(thumbnails) / columns)
+
+    sheet = np.zeros((rows * cell_h, columns * cell_w, channels), np.uint8)
+    boxes = []
+    for i, thumbnail in enumerate(thumbnails):
+        if thumbnail is None:
+            boxes.append(None)
+            continue
+        if thumbnail.ndim == 2:
+            thumbnail = cv2.cvtColor(thumbnail, cv2.COLOR_GRAY2BGR)
+        if thumbnail.shape[2] != channels:
+            thumbnail = cv2.cvtColor(thumbnail, cv2.COLOR_BGR2BGRA)
+        h, w = thumbnail.shape[:2]
+        y, x = (i // columns) * cell_h, (i % columns) * cell_w
+        sheet[y:y + h, x:x + w] = thumbnail
+        boxes.append((x, y, w, h))
+    return sheet, boxes
+
+
+def _compose_and_encode(thumbnails: list, columns: int, options: OutputOptions):
+    sheet, boxes = _compose(thumbnails, columns)
+    # Transparency (e.g. from bgrem) needs PNG; everything else packs well as JPEG.
+    encoding = options.encoding_for(".png" if sheet.shape[2] == 4 else ".jpg")
+    return encoding.encode(sheet), encoding, boxes
+
+
+async def render_sprite_sheet(steps: list, img: np.ndarray, columns: int = None, options: OutputOptions = None):
+    """
+    Renders `img` through every step on its own and packs the results into a
+    single image, so a client gets all thumbnails with one response and one
+    decode. Like run_pipeline(), filters with an `under_load` hook have their
+    params adjusted to the current load, and like run_fanout() they wait for
+    room on the pool.
+
+    Returns:
+        (encoded, encoding, layout): the encoded sheet and, per step in order,
+        a dict with the filter name and either its x, y, width and height on
+        the sheet or the status and detail of the error that stopped it.
+    """
+    steps = [(spec, spec.with_preview(params)) for spec, params in steps]
+    columns = columns or math.ceil(math.sqrt(len(steps)))
+    # A generator, so each filter's load is read when its job actually starts.
+    jobs = (
+        batch.item(i, None, run_task([spec], _thumbnail, spec.func,
+                                     spec.under_load(params, load(spec)) if spec.under_load else params,
+                                     img, wait=True))
+        for i, (spec, params) in enumerate(steps)
+    )
+    thumbnails, errors = [None] * len(steps), {}
+    async for i, _, result, error in batch.as_finished(jobs, batch.window_for([spec for spec, _ in steps])):
+        thumbnails[i], errors[i] = result, error
+
+    encoded, encoding, boxes = await run_light(_compose_and_encode, thumbnails, columns, options or OutputOptions())
+    layout = []
+    for i, ((spec, _), box) in enumerate(zip(steps, boxes)):
+        if box is None:
+            layout.append({"filter": spec.name, "status": errors[i].status_code, "detail": str(errors[i].detail)})
+        else:
+            x, y, w, h = box
+            layout.append({"filter": spec.name, "x": x, "y": y, "width": w, "height": h})
+    return encoded, encoding, layout
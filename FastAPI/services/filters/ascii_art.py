@@ -1,95 +1,172 @@
+import functools
+import html
 import cv2
 import numpy as np
-from fastapi import UploadFile
-from services.utils import read_image_from_upload, encode_image_to_bytes
+from typing import Literal
+from pydantic import BaseModel, Field
+from services.registry import FilterSpec
 
 ASCII_CHARS = "@%#*+=-:. "
 
-def image_to_ascii_image(img, num_cols=120, bg_color=(255, 255, 255), font_color=(0, 0, 0)):
-    if img is None:
-        return np.full((100, 100, 3), bg_color, dtype=np.uint8)
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+FONT_SCALE = 0.4
+THICKNESS = 1
+
+# Blank margin around the rendered text, in pixels.
+PADDING = 5
+
+@functools.lru_cache(maxsize=8)
+def _glyph_atlas(chars: str = ASCII_CHARS) -> np.ndarray:
+    """
+    Every glyph of `chars` rasterized once with anti-aliasing, as a
+    (len(chars), cell_h, cell_w) uint8 array of coverage. Cells and glyph
+    positions are those of the original per-character putText renderer;
+    the glyphs of ASCII_CHARS all fit inside their cell.
+    """
+    (cell_w, cell_h), baseline = cv2.getTextSize("@", FONT, FONT_SCALE, THICKNESS)
+    cell_w = max(1, cell_w)
+    cell_h = max(1, cell_h)
+
+    atlas = np.zeros((len(chars), cell_h, cell_w), dtype=np.uint8)
+    for i, char in enumerate(chars):
+        cv2.putText(atlas[i], char, (0, cell_h - baseline), FONT, FONT_SCALE, 255, THICKNESS, lineType=cv2.LINE_AA)
+    return atlas
+
+def _char_lut(num_chars: int) -> np.ndarray:
+    """Maps brightness 0-255 to an index into ASCII_CHARS, darkest first."""
+    scale = max(1, 256 // num_chars)
+    return np.minimum(np.arange(256) // scale, num_chars - 1).astype(np.uint8)
+
+def _ascii_grid(img, num_cols: int, with_colors: bool = False):
+    """
+    Resizes `img` to the character grid.
+
+    Returns:
+        (indices, colors): the ASCII_CHARS index of every cell and, with
+        `with_colors`, the mean BGR colour of every cell (else None), both
+        with one row per line of text.
+    """
+    cell_h, cell_w = _glyph_atlas().shape[1:]
+    height, width = img.shape[:2]
+    num_rows = max(1, int(height * num_cols * (cell_h / cell_w) / width))
 
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    gray = cv2.resize(gray, (num_cols, num_rows), interpolation=cv2.INTER_LINEAR)
+    indices = cv2.LUT(gray, _char_lut(len(ASCII_CHARS)))
+    colors = cv2.resize(img, (num_cols, num_rows), interpolation=cv2.INTER_AREA) if with_colors else None
+    return indices, colors
+
+def image_to_ascii_image(img, num_cols=120, color=False, bg_color=(255, 255, 255), font_color=(0, 0, 0)):
+    """
+    Renders the image as ASCII art at its original size.
+
+    Args:
+        img: BGR image.
+        num_cols: Characters per line.
+        color: Draw each character in the colour of the area it covers
+               instead of `font_color`.
+        bg_color: Background colour.
+        font_color: Text colour.
+
+    Returns:
+        The rendered BGR image.
+    """
     original_height, original_width = img.shape[:2]
-
     if original_height == 0 or original_width == 0:
         return np.full((max(1, original_height), max(1, original_width), 3), bg_color, dtype=np.uint8)
 
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    
-    font = cv2.FONT_HERSHEY_SIMPLEX
-    font_scale = 0.4 
-    thickness = 1
-
-    try:
-        (char_cell_w, char_cell_h), baseline = cv2.getTextSize("@", font, font_scale, thickness)
-    except cv2.error: 
-        (char_cell_w, char_cell_h), baseline = cv2.getTextSize("A", font, font_scale, thickness)
-
-    if char_cell_w == 0: char_cell_w = int(font_scale * 15) or 1
-    if char_cell_h == 0: char_cell_h = int(font_scale * 15) or 1
-    if baseline == 0 and char_cell_h > 0 : baseline = int(char_cell_h * 0.2) 
+    indices, colors = _ascii_grid(img, num_cols, with_colors=color)
+    atlas = _glyph_atlas()
+    cell_h, cell_w = atlas.shape[1:]
+    num_rows = indices.shape[0]
 
-    glyph_aspect_ratio = char_cell_h / char_cell_w if char_cell_w > 0 else 1.0
+    # Stamp the glyph tiles: (rows, cols, cell_h, cell_w) -> one text plane.
+    coverage = atlas[indices].transpose(0, 2, 1, 3).reshape(num_rows * cell_h, num_cols * cell_w)
+    coverage = cv2.copyMakeBorder(coverage, PADDING, PADDING, PADDING, PADDING, cv2.BORDER_CONSTANT, value=0)
+    text_h, text_w = coverage.shape
 
-    num_rows_for_grid = int((original_height * num_cols * glyph_aspect_ratio) / original_width) if original_width > 0 else int(original_height * glyph_aspect_ratio)
-    num_rows_for_grid = max(1, num_rows_for_grid)
-
-    resized_gray = cv2.resize(gray, (num_cols, num_rows_for_grid), interpolation=cv2.INTER_LINEAR)
-
-    if not ASCII_CHARS:
-        effective_ascii_chars = [" "]
+    # Colour the text at the output size: coverage is a single channel, so
+    # resizing it first is much cheaper than resizing the coloured image.
+    if text_w * text_h > original_width * original_height:
+        interpolation = cv2.INTER_AREA
     else:
-        effective_ascii_chars = list(ASCII_CHARS)
-    
-    num_ascii_chars = len(effective_ascii_chars)
-    
-    # Using the exact scaling method from the original snippet for character mapping
-    # scale = 256 // num_ascii_chars
-    # This can be 0 if num_ascii_chars > 256. For the given ASCII_CHARS, it's 256 // 10 = 25.
-    char_map_scale = 256 // num_ascii_chars if num_ascii_chars > 0 else 255 
-    if char_map_scale == 0: # Avoid division by zero if num_ascii_chars is very large (e.g. > 256)
-        char_map_scale = 1 
-
-
-    ascii_lines = []
-    for r in range(num_rows_for_grid):
-        line_chars = []
-        for c in range(num_cols):
-            pixel_value = resized_gray[r, c]
-            char_index = min(pixel_value // char_map_scale, num_ascii_chars - 1)
-            line_chars.append(effective_ascii_chars[char_index])
-        ascii_lines.append("".join(line_chars))
-    
-    padding = 5 
-    intermediate_img_width = char_cell_w * num_cols + 2 * padding
-    intermediate_img_height = char_cell_h * num_rows_for_grid + 2 * padding
-    
-    intermediate_img_width = max(1, int(intermediate_img_width))
-    intermediate_img_height = max(1, int(intermediate_img_height))
-
-    ascii_intermediate_img = np.full((intermediate_img_height, intermediate_img_width, 3), bg_color, dtype=np.uint8)
-
-    for i, line_text in enumerate(ascii_lines):
-        y_baseline = padding + (char_cell_h - baseline) + (i * char_cell_h)
-        current_x = padding
-        for char_to_draw in line_text:
-            cv2.putText(ascii_intermediate_img, char_to_draw, 
-                        (int(current_x), int(y_baseline)), 
-                        font, font_scale, font_color, thickness, lineType=cv2.LINE_AA)
-            current_x += char_cell_w 
-
-    if original_width > 0 and original_height > 0:
-        if intermediate_img_width * intermediate_img_height > original_width * original_height and intermediate_img_width > 0 and intermediate_img_height > 0 :
-            interpolation_method = cv2.INTER_AREA
-        else: 
-            interpolation_method = cv2.INTER_CUBIC 
-        final_ascii_img = cv2.resize(ascii_intermediate_img, (original_width, original_height), interpolation=interpolation_method)
+        interpolation = cv2.INTER_CUBIC
+    alpha = cv2.resize(coverage, (original_width, original_height), interpolation=interpolation)
+    alpha = cv2.merge([alpha] * 3)
+
+    if not color:
+        # Blend between the two fixed colours with a per-channel lookup table.
+        ramp = np.arange(256, dtype=np.float32)[:, None] / 255
+        lut = np.asarray(bg_color, np.float32) * (1 - ramp) + np.asarray(font_color, np.float32) * ramp
+        return cv2.LUT(alpha, np.rint(lut).astype(np.uint8).reshape(256, 1, 3))
+
+    # Sample the colour of the cell under every output pixel.
+    scale_x, scale_y = original_width / text_w, original_height / text_h
+    to_cell = np.float32([
+        [1 / (scale_x * cell_w), 0, (0.5 / scale_x - PADDING) / cell_w - 0.5],
+        [0, 1 / (scale_y * cell_h), (0.5 / scale_y - PADDING) / cell_h - 0.5],
+    ])
+    ink = cv2.warpAffine(colors, to_cell, (original_width, original_height),
+                         flags=cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP,
+                         borderMode=cv2.BORDER_CONSTANT, borderValue=bg_color)
+    background = np.full_like(ink, bg_color)
+    return cv2.add(cv2.multiply(ink, alpha, scale=1.0 / 255),
+                   cv2.multiply(background, 255 - alpha, scale=1.0 / 255))
+
+def image_to_ascii_text(img, num_cols=120, color=False, as_html=False):
+    """
+    Renders the image as ASCII art text.
+
+    Args:
+        img: BGR image.
+        num_cols: Characters per line.
+        color: Only used with `as_html`; wraps runs of characters in spans
+               coloured like the area they cover.
+        as_html: Return an HTML <pre> block instead of plain text.
+
+    Returns:
+        The text, one line per row of characters.
+    """
+    indices, colors = _ascii_grid(img, num_cols, with_colors=color and as_html)
+    chars = np.array(list(ASCII_CHARS))
+    lines = ["".join(row) for row in chars[indices]]
+    if not as_html:
+        return "\n".join(lines) + "\n"
+
+    if not color:
+        body = "\n".join(html.escape(line) for line in lines)
     else:
-        final_ascii_img = ascii_intermediate_img 
-
-    return final_ascii_img
-
-async def process(file: UploadFile): # Minimal change to this part as requested
-    img = await read_image_from_upload(file) # Assuming this function exists
-    ascii_img = image_to_ascii_image(img)
-    return encode_image_to_bytes(ascii_img) # Assuming this function exists
\ No newline at end of file
+        rgb = colors[..., ::-1]
+        body_lines = []
+        for line, row in zip(lines, rgb):
+            hex_colors = ["#%02x%02x%02x" % tuple(pixel) for pixel in row.tolist()]
+            spans, start = [], 0
+            # Adjacent characters of the same colour share one span.
+            for end in range(1, len(line) + 1):
+                if end == len(line) or hex_colors[end] != hex_colors[start]:
+                    spans.append(f'<span style="color:{hex_colors[start]}">{html.escape(line[start:end])}</span>')
+                    start = end
+            body_lines.append("".join(spans))
+        body = "\n".join(body_lines)
+    return f'<pre style="font-family:monospace;line-height:1">\n{body}\n</pre>\n'
+
+def render_ascii(img, num_cols=120, color=False, output="image"):
+    """Dispatches to the image, text or HTML renderer according to `output`."""
+    if output == "image":
+        return image_to_ascii_image(img, num_cols=num_cols, color=color)
+    return image_to_ascii_text(img, num_cols=num_cols, color=color, as_html=output == "html")
+
+
+class AsciiParams(BaseModel):
+    num_cols: int = Field(120, ge=10, le=400, description="Characters per line.")
+    color: bool = Field(False, description="Colour each character like the area it covers.")
+    output: Literal["image", "text", "html"] = Field("image", description="Render to an image, plain text or HTML.")
+
+
+SPEC = FilterSpec(
+    name="ascii_art",
+    func=render_ascii,
+    params=AsciiParams,
+    formats={"text": ".txt", "html": ".html"},
+    max_dim=1600,
+)
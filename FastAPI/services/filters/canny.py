@@ -1,11 +1,8 @@
 import cv2
-from fastapi import UploadFile
-from services.utils import read_image_from_upload, encode_image_to_bytes
+from services.registry import FilterSpec
 
 
-async def process(file: UploadFile):
-    img = await read_image_from_upload(file)
-
+def canny_edges(img):
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
 
     
@@ -17,4 +14,7 @@ async def process(file: UploadFile):
 
     edges = cv2.Canny(blurred, threshold1=low_threshold, threshold2=high_threshold, L2gradient=True)
 
-    return encode_image_to_bytes(edges)
\ No newline at end of file
+    return edges
+
+
+SPEC = FilterSpec(name="canny", func=canny_edges, format=".png")
@@ -1,9 +1,9 @@
 import cv2
-from fastapi import UploadFile
-from services.utils import read_image_from_upload, encode_image_to_bytes
+from services.registry import FilterSpec
 
-async def process(file: UploadFile):
-    img = await read_image_from_upload(file)
-    
+def color_sketch(img):
     dst_gray, dst_color = cv2.pencilSketch(img, sigma_s=60, sigma_r=0.07, shade_factor=0.05)
-    return encode_image_to_bytes(dst_color)
+    return dst_color
+
+
+SPEC = FilterSpec(name="color_sketch", func=color_sketch, cost="medium")
@@ -1,10 +1,14 @@
 import cv2
-from fastapi import UploadFile
-from services.utils import read_image_from_upload, encode_image_to_bytes
+from services.registry import FilterSpec
+from services.tiling import map_tiles
 
-async def process(file: UploadFile):
-    img = await read_image_from_upload(file)
+# medianBlur(5) feeding adaptiveThreshold(9) reaches 2 + 4 pixels out.
+HALO = 6
 
+def comic_effect(img):
+    return map_tiles(_comic_tile, img, HALO)
+
+def _comic_tile(img):
     # Convert to gray
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
 
@@ -24,4 +28,7 @@ async def process(file: UploadFile):
     
     cartoon = cv2.bitwise_and(color_smoothed, color_smoothed, mask=edges)
 
-    return encode_image_to_bytes(cartoon)
\ No newline at end of file
+    return cartoon
+
+
+SPEC = FilterSpec(name="comic", func=comic_effect, cost="medium")
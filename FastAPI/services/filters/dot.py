@@ -1,40 +1,123 @@
+import functools
 import cv2
 import numpy as np
-from fastapi import UploadFile
-from services.utils import read_image_from_upload, encode_image_to_bytes
+from typing import Literal
+from pydantic import BaseModel, Field
+from services.registry import FilterSpec
 
-async def process(file: UploadFile, block_size: int = 8):
+# Screen angles of the C, M, Y and K plates relative to the requested angle.
+# Offsetting the plates keeps their dot grids from forming moire patterns.
+CMYK_ANGLES = (15.0, 75.0, 0.0, 45.0)
+
+@functools.lru_cache(maxsize=16)
+def _dot_sprites(block_size: int) -> np.ndarray:
+    """
+    The dot for every ink level 0-255, as a (256, block_size, block_size)
+    uint8 array of coverage. Dots are drawn like the original per-block
+    renderer: a filled cv2.circle centred on the block, its radius the ink
+    level scaled to half the block size and truncated to whole pixels.
+    """
+    sprites = np.zeros((256, block_size, block_size), dtype=np.uint8)
+    center = (block_size // 2, block_size // 2)
+    for level in range(256):
+        radius = level * (block_size // 2) // 255
+        if radius > 0:
+            cv2.circle(sprites[level], center, radius, 255, -1)
+    return sprites
+
+def _screen(ink: np.ndarray, block_size: int, colors: np.ndarray = None):
+    """
+    Halftones an axis-aligned ink plane (uint8, 255 = full ink).
+
+    Returns the dot coverage at the size of `ink`. If `colors` (a BGR image of
+    the same size) is given, also returns the per-block mean colour expanded
+    to full size, for colouring the dots.
     """
-    Applies a halftone-like dot effect by reducing the image resolution in blocks,
-    replacing each block with a dot (circle) whose radius depends on brightness.
-    
+    h, w = ink.shape
+    bh, bw = -(-h // block_size), -(-w // block_size)
+    pad_y, pad_x = bh * block_size - h, bw * block_size - w
+
+    # One INTER_AREA resize gives the mean of every block.
+    padded = cv2.copyMakeBorder(ink, 0, pad_y, 0, pad_x, cv2.BORDER_REPLICATE)
+    means = cv2.resize(padded, (bw, bh), interpolation=cv2.INTER_AREA)
+
+    # Gather whole sprite rows, viewed as opaque block_size-byte items,
+    # straight into (block row, sprite row, block column) order, which is the
+    # output layout, instead of stamping tiles and transposing them.
+    sprite_rows = _dot_sprites(block_size).view(np.dtype((np.void, block_size)))[..., 0]
+    rows = sprite_rows[means[:, None, :], np.arange(block_size)[:, None]]
+    coverage = rows.view(np.uint8).reshape(bh * block_size, bw * block_size)[:h, :w]
+    if colors is None:
+        return coverage
+
+    padded = cv2.copyMakeBorder(colors, 0, pad_y, 0, pad_x, cv2.BORDER_REPLICATE)
+    block_colors = cv2.resize(padded, (bw, bh), interpolation=cv2.INTER_AREA)
+    block_colors = cv2.resize(block_colors, (bw * block_size, bh * block_size), interpolation=cv2.INTER_NEAREST)
+    return coverage, block_colors[:h, :w]
+
+def _rotated(fn, img: np.ndarray, angle: float, border):
+    """Applies `fn` on `img` rotated by `angle` degrees, then rotates the result back."""
+    if angle % 360 == 0:
+        return fn(img)
+    h, w = img.shape[:2]
+    m = cv2.getRotationMatrix2D((w / 2.0, h / 2.0), angle, 1.0)
+    cos, sin = abs(m[0, 0]), abs(m[0, 1])
+    rw, rh = int(np.ceil(w * cos + h * sin)), int(np.ceil(w * sin + h * cos))
+    m[0, 2] += rw / 2.0 - w / 2.0
+    m[1, 2] += rh / 2.0 - h / 2.0
+
+    rotated = cv2.warpAffine(img, m, (rw, rh), flags=cv2.INTER_LINEAR, borderValue=border)
+    out = fn(rotated)
+    return cv2.warpAffine(out, m, (w, h), flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP)
+
+def halftone_dots(img, block_size: int = 8, mode: str = "mono", angle: float = 0.0):
+    """
+    Applies a halftone dot effect: the image is divided into blocks and each
+    block is replaced with a dot whose size depends on how dark the block is.
+
     Args:
-        file: Uploaded image.
+        img: BGR image.
         block_size: Size of blocks used to generate dots.
-    
+        mode: "mono" for black dots on white, "color" for dots filled with
+              the block's mean colour, "cmyk" for four overlaid process-colour
+              screens.
+        angle: Screen angle in degrees.
+
     Returns:
         Image with dot effect.
     """
-    img = await read_image_from_upload(file)
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    h, w = gray.shape
-
-    # Create a blank white canvas
-    dot_img = np.ones_like(img) * 255
+    if mode == "cmyk":
+        b, g, r = cv2.split(img)
+        mx = cv2.max(cv2.max(b, g), r)
+        # C = (1 - R - K) / (1 - K) with K = 1 - max(R, G, B), in 0-255 units.
+        plates = [cv2.divide(mx - r, mx, scale=255), cv2.divide(mx - g, mx, scale=255),
+                  cv2.divide(mx - b, mx, scale=255), 255 - mx]
+        c, m, y, k = [
+            255 - _rotated(lambda p: _screen(p, block_size), plate, angle + offset, 0)
+            for plate, offset in zip(plates, CMYK_ANGLES)
+        ]
+        scale = 1.0 / 255
+        return cv2.merge([cv2.multiply(y, k, scale=scale),
+                          cv2.multiply(m, k, scale=scale),
+                          cv2.multiply(c, k, scale=scale)])
 
-    for y in range(0, h, block_size):
-        for x in range(0, w, block_size):
-            block = gray[y:y+block_size, x:x+block_size]
-            avg_intensity = np.mean(block)
-            radius = int((1 - avg_intensity / 255) * (block_size // 2))
-
-            center_x = x + block_size // 2
-            center_y = y + block_size // 2
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    if mode == "color":
+        def render(bgr):
+            coverage, colors = _screen(255 - cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY), block_size, bgr)
+            # White paper blended towards the block colour by dot coverage.
+            ink = cv2.multiply(255 - colors, cv2.merge([coverage] * 3), scale=1.0 / 255)
+            return 255 - ink
+        return _rotated(render, img, angle, (255, 255, 255))
 
-            if radius > 0:
-                cv2.circle(dot_img, (center_x, center_y), radius, (0, 0, 0), -1)
+    dots = _rotated(lambda g: 255 - _screen(255 - g, block_size), gray, angle, 255)
+    return cv2.cvtColor(dots, cv2.COLOR_GRAY2BGR)
 
-    return encode_image_to_bytes(dot_img)
 
+class DotParams(BaseModel):
+    block_size: int = Field(8, ge=2, le=64, description="Size of blocks used to generate dots.")
+    mode: Literal["mono", "color", "cmyk"] = Field("mono", description="Black, block-coloured or CMYK dots.")
+    angle: float = Field(0.0, ge=-90.0, le=90.0, description="Screen angle in degrees.")
 
 
+SPEC = FilterSpec(name="dot", func=halftone_dots, params=DotParams, format=".png")
\ No newline at end of file
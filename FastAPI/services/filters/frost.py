@@ -1,19 +1,47 @@
 import cv2
 import numpy as np
-from fastapi import UploadFile
-from services.utils import read_image_from_upload, encode_image_to_bytes
+from typing import Optional
+from pydantic import BaseModel, Field
+from services.registry import FilterSpec
 
-def frosted_glass(img, radius=3):
-    output = img.copy()
+# cv2.remap only takes images whose sides are below SHRT_MAX.
+REMAP_MAX_DIM = 32767
+
+def frosted_glass(img, radius=3, seed=None):
+    """
+    Replaces every pixel with a random neighbour up to `radius` pixels away.
+
+    Offsets are drawn in bulk and applied with a single cv2.remap. Like the
+    original per-pixel loop they lie in [-radius, radius), and pixels within
+    `radius` of the border are left unchanged.
+    """
     h, w = img.shape[:2]
-    for y in range(radius, h - radius):
-        for x in range(radius, w - radius):
-            rand_x = x + np.random.randint(-radius, radius)
-            rand_y = y + np.random.randint(-radius, radius)
-            output[y, x] = img[rand_y, rand_x]
-    return output
-
-async def process(file: UploadFile):
-    img = await read_image_from_upload(file)
-    output = frosted_glass(img)
-    return encode_image_to_bytes(output)
+    if h <= 2 * radius or w <= 2 * radius:
+        return img.copy()
+
+    rng = np.random.default_rng(seed)
+    offsets = rng.integers(-radius, radius, size=(h - 2 * radius, w - 2 * radius, 2), dtype=np.int8)
+
+    if max(h, w) >= REMAP_MAX_DIM:
+        # Too large for cv2.remap (and for int16 maps): gather with numpy.
+        out = img.copy()
+        ys = np.arange(radius, h - radius, dtype=np.int32)[:, None] + offsets[..., 1]
+        xs = np.arange(radius, w - radius, dtype=np.int32) + offsets[..., 0]
+        out[radius:h - radius, radius:w - radius] = img[ys, xs]
+        return out
+
+    # Absolute source coordinates as (x, y) pairs, the CV_16SC2 map layout.
+    maps = np.empty((h, w, 2), dtype=np.int16)
+    maps[..., 0] = np.arange(w, dtype=np.int16)
+    maps[..., 1] = np.arange(h, dtype=np.int16)[:, None]
+    maps[radius:h - radius, radius:w - radius] += offsets
+
+    return cv2.remap(img, maps, None, cv2.INTER_NEAREST)
+
+
+class FrostParams(BaseModel):
+    radius: int = Field(3, ge=1, le=20, description="How far, in pixels, each pixel may be displaced.")
+    seed: Optional[int] = Field(None, ge=0, description="Random seed. Makes the result reproducible and cacheable.")
+
+
+SPEC = FilterSpec(name="frost", func=frosted_glass, params=FrostParams, deterministic=False, cost="medium")
\ No newline at end of file
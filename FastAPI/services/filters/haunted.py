@@ -1,46 +1,54 @@
+import functools
 import cv2
 import numpy as np
-from fastapi import UploadFile
-from services.utils import read_image_from_upload, encode_image_to_bytes
+from typing import Optional
+from pydantic import BaseModel, Field
+from services.lut import LEVELS, per_channel, to_table
+from services.registry import FilterSpec
 
-async def process(
-    file: UploadFile,
+# BGR for a cold, murky blue
+FOG_COLOR = (150, 120, 100)
+
+@functools.lru_cache(maxsize=32)
+def _fog_table(fog_density: float):
+    return per_channel([to_table(LEVELS * (1 - fog_density) + channel * fog_density) for channel in FOG_COLOR])
+
+def haunted_effect(
+    img: np.ndarray,
     fog_density: float = 0.5,
     vignette_strength: float = 1.5,
-    grain_amount: int = 25
+    grain_amount: int = 25,
+    seed: Optional[int] = None
 ):
     """
-    Applies a creepy, haunted filter to an uploaded image.
+    Applies a creepy, haunted filter to an image.
 
     This effect combines a cold color tint, a foggy/low-contrast look,
     film grain, and a dark vignette to create an eerie atmosphere.
 
     Args:
-        file: The uploaded image file.
+        img: The BGR image.
         fog_density: Controls how washed-out and foggy the image appears.
                      Ranges from 0 (no fog) to 1 (full fog).
         vignette_strength: Controls the intensity of the dark corners.
                            Higher values make the vignette darker and more focused.
         grain_amount: The intensity of the film grain noise.
+        seed: Seed for the grain noise, for reproducible output.
 
     Returns:
         The processed image with the haunted effect.
     """
-    img = await read_image_from_upload(file)
-    if img is None:
-        return None
-
     height, width, _ = img.shape
 
     # 1. Apply a cold, foggy color tint.
     # We blend the original image with a solid, cold-bluish color.
     # This single step handles desaturation, tinting, and contrast reduction.
-    color_tint = np.full_like(img, (150, 120, 100), dtype=np.uint8) # BGR for a cold, murky blue
-    haunted_img = cv2.addWeighted(img, 1 - fog_density, color_tint, fog_density, 0)
+    haunted_img = cv2.LUT(img, _fog_table(fog_density))
 
     # 2. Add film grain.
     # We generate Gaussian noise and add it to the image.
-    noise = np.random.normal(0, grain_amount, haunted_img.shape).astype(np.int16)
+    rng = np.random.default_rng(seed)
+    noise = rng.normal(0, grain_amount, haunted_img.shape).astype(np.int16)
     haunted_img = np.clip(haunted_img.astype(np.int16) + noise, 0, 255).astype(np.uint8)
 
     # 3. Create and apply a dark vignette.
@@ -57,5 +65,14 @@ async def process(
     for i in range(3):
         haunted_img[:, :, i] = haunted_img[:, :, i] * vignette_mask
 
-    return encode_image_to_bytes(haunted_img)
+    return haunted_img
+
+
+class HauntedParams(BaseModel):
+    fog_density: float = Field(0.5, ge=0.0, le=1.0, description="How washed-out and foggy the image appears.")
+    vignette_strength: float = Field(1.5, gt=0.0, le=10.0, description="Intensity of the dark corners.")
+    grain_amount: int = Field(25, ge=0, le=100, description="Intensity of the film grain noise.")
+    seed: Optional[int] = Field(None, ge=0, description="Random seed. Makes the result reproducible and cacheable.")
+
 
+SPEC = FilterSpec(name="haunted", func=haunted_effect, params=HauntedParams, deterministic=False)
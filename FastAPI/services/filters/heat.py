@@ -1,14 +1,19 @@
+import functools
 import cv2
-import numpy as np
-from fastapi import UploadFile
-from services.utils import read_image_from_upload, encode_image_to_bytes
-
-async def process(file: UploadFile):
-    img = await read_image_from_upload(file)
-    
-    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-    hsv[..., 1] = cv2.equalizeHist(hsv[..., 1])  # Boost saturation
-    hsv[..., 2] = np.clip(hsv[..., 2] * 1.2, 0, 255).astype(np.uint8)  # Boost brightness
-    
-    neon = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
-    return encode_image_to_bytes(neon)
+from services.lut import LEVELS, to_table
+from services.registry import FilterSpec
+
+@functools.lru_cache(maxsize=None)
+def _brightness_table():
+    return to_table(LEVELS * 1.2, rounding=False)
+
+def heat_map(img):
+    h, s, v = cv2.split(cv2.cvtColor(img, cv2.COLOR_BGR2HSV))
+    s = cv2.equalizeHist(s)  # Boost saturation
+    v = cv2.LUT(v, _brightness_table())  # Boost brightness
+
+    neon = cv2.cvtColor(cv2.merge([h, s, v]), cv2.COLOR_HSV2BGR)
+    return neon
+
+
+SPEC = FilterSpec(name="heat", func=heat_map)
@@ -1,9 +1,7 @@
 import cv2
-from fastapi import UploadFile
-from services.utils import read_image_from_upload, encode_image_to_bytes
+from services.registry import FilterSpec
 
-async def process(file: UploadFile):
-    img = await read_image_from_upload(file)
+def pixelate_image(img):
     height, width = img.shape[:2]
 
     # Pixelation by resizing down then up
@@ -11,4 +9,7 @@ async def process(file: UploadFile):
     temp = cv2.resize(img, (w, h), interpolation=cv2.INTER_LINEAR)
     pixelated = cv2.resize(temp, (width, height), interpolation=cv2.INTER_NEAREST)
 
-    return encode_image_to_bytes(pixelated)
+    return pixelated
+
+
+SPEC = FilterSpec(name="pixelate", func=pixelate_image, format=".png")
@@ -1,11 +1,10 @@
 import cv2
 import numpy as np
-from fastapi import UploadFile
-from services.utils import read_image_from_upload, encode_image_to_bytes
-
-async def process(file: UploadFile):
-    img = await read_image_from_upload(file)
+from typing import Optional
+from pydantic import BaseModel, Field
+from services.registry import FilterSpec
 
+def pencil_sketch(img, seed=None):
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
 
     inverted = cv2.bitwise_not(gray)
@@ -14,7 +13,15 @@ async def process(file: UploadFile):
 
     sketch = cv2.divide(gray, 255 - blurred, scale=256)
 
-    noise = np.random.normal(0, 1, sketch.shape).astype(np.uint8)
+    rng = np.random.default_rng(seed)
+    noise = rng.normal(0, 1, sketch.shape).astype(np.uint8)
     sketch = cv2.add(sketch, noise)
 
-    return encode_image_to_bytes(sketch)
\ No newline at end of file
+    return sketch
+
+
+class SketchParams(BaseModel):
+    seed: Optional[int] = Field(None, ge=0, description="Random seed. Makes the result reproducible and cacheable.")
+
+
+SPEC = FilterSpec(name="sketch", func=pencil_sketch, params=SketchParams, deterministic=False)
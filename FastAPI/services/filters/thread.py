@@ -1,7 +1,7 @@
 import cv2
 import numpy as np
-from fastapi import UploadFile
-from services.utils import read_image_from_upload, encode_image_to_bytes
+from pydantic import BaseModel, Field, field_validator
+from services.registry import FilterSpec
 
 def _create_hatch_texture(shape, spacing):
     """Helper function to create a simple cross-hatch texture."""
@@ -14,7 +14,7 @@ def _create_hatch_texture(shape, spacing):
         cv2.line(hatch, (i, 0), (i + shape[0], shape[0]), 0, 1)
     return hatch
 
-async def process(file: UploadFile, blur_level: int = 5, shadow_threshold: int = 100, line_thickness: int = 1):
+def thread_sketch(img: np.ndarray, blur_level: int = 5, shadow_threshold: int = 100, line_thickness: int = 1) -> np.ndarray:
     """
     Applies a more artistic and less distorted thread sketch filter.
 
@@ -22,7 +22,7 @@ async def process(file: UploadFile, blur_level: int = 5, shadow_threshold: int =
     cross-hatch texture for shading, creating a more authentic look.
 
     Args:
-        file: The uploaded image file.
+        img: The BGR image.
         blur_level: The amount of simplification before edge detection. Must be an odd number.
                     Higher values create smoother, more abstract lines. (e.g., 3, 5, 7)
         shadow_threshold: The brightness level below which shading is applied.
@@ -33,10 +33,6 @@ async def process(file: UploadFile, blur_level: int = 5, shadow_threshold: int =
     Returns:
         The processed image with the improved thread sketch effect.
     """
-    img = await read_image_from_upload(file)
-    if img is None:
-        return None
-
     # 1. Get the grayscale image for processing.
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
 
@@ -74,4 +70,20 @@ async def process(file: UploadFile, blur_level: int = 5, shadow_threshold: int =
     # Convert back to BGR for consistent API output.
     final_image = cv2.cvtColor(final_sketch, cv2.COLOR_GRAY2BGR)
 
-    return encode_image_to_bytes(final_image)
+    return final_image
+
+
+class ThreadParams(BaseModel):
+    blur_level: int = Field(5, ge=1, le=15, description="Simplification before edge detection. Must be odd.")
+    shadow_threshold: int = Field(100, ge=0, le=255, description="Brightness below which shading is applied.")
+    line_thickness: int = Field(1, ge=1, le=10, description="Thickness of the main outlines.")
+
+    @field_validator("blur_level")
+    @classmethod
+    def _odd_blur_level(cls, value):
+        if value % 2 == 0:
+            raise ValueError("blur_level must be an odd number")
+        return value
+
+
+SPEC = FilterSpec(name="thread", func=thread_sketch, params=ThreadParams, format=".png")
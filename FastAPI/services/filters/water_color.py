@@ -1,9 +1,13 @@
 import cv2
-from fastapi import UploadFile
-from services.utils import read_image_from_upload, encode_image_to_bytes
-
-async def process(file: UploadFile):
-    img = await read_image_from_upload(file)
-    
-    stylized = cv2.stylization(img, sigma_s=60, sigma_r=0.6)
-    return encode_image_to_bytes(stylized)
+from services.registry import FilterSpec
+from services.tiling import map_tiles
+
+# stylization() smooths recursively, so its reach has no hard limit; one and
+# a half times sigma_s keeps seams within a couple of grey levels.
+HALO = 90
+
+def water_color(img):
+    return map_tiles(lambda tile: cv2.stylization(tile, sigma_s=60, sigma_r=0.6), img, HALO)
+
+
+SPEC = FilterSpec(name="water_color", func=water_color, cost="medium", max_dim=2048)
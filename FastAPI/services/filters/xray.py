@@ -1,7 +1,15 @@
+import functools
 import cv2
 import numpy as np
-from fastapi import UploadFile
-from services.utils import read_image_from_upload, encode_image_to_bytes
+from services.lut import LEVELS, to_table
+from services.registry import FilterSpec
+
+@functools.lru_cache(maxsize=None)
+def _xray_table():
+    # Invert, then adjust alpha (contrast) and beta (brightness). Evaluated
+    # with cv2 itself over all 256 levels so its rounding is kept exactly.
+    inverted = cv2.bitwise_not(LEVELS.astype(np.uint8))
+    return to_table(cv2.convertScaleAbs(inverted, alpha=1.7, beta=-10).ravel())
 
 def xray_filter(img):
     if img is None:
@@ -20,18 +28,11 @@ def xray_filter(img):
         xray_fallback = cv2.convertScaleAbs(inverted_original, alpha=1.5, beta=0)
         return xray_fallback
 
-    inverted_gray = cv2.bitwise_not(gray)
-    
-    
-    # Adjust alpha (contrast) and beta (brightness)
-    # Higher alpha increases contrast, negative beta can make darks darker
-    xray_effect_gray = cv2.convertScaleAbs(inverted_gray, alpha=1.7, beta=-10)
+    xray_effect_gray = cv2.LUT(gray, _xray_table())
     
     xray_effect_bgr = cv2.cvtColor(xray_effect_gray, cv2.COLOR_GRAY2BGR)
     
     return xray_effect_bgr
 
-async def process(file: UploadFile):
-    img = await read_image_from_upload(file)
-    output = xray_filter(img)
-    return encode_image_to_bytes(output)
\ No newline at end of file
+
+SPEC = FilterSpec(name="xray", func=xray_filter)
@@ -0,0 +1,151 @@
+import asyncio
+import secrets
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+import cv2
+import numpy as np
+from fastapi import HTTPException
+from services.utils import env_int
+
+# Long-edge sizes of the downscaled copies prebuilt at upload time, largest first.
+VARIANT_SIZES = (1024, 512, 256)
+
+
+@dataclass
+class StoredImage:
+    """
+    A decoded upload plus prebuilt downscaled copies, keyed by long edge.
+
+    Every upload gets its own random `image_id`, even for identical bytes,
+    so per-image state and deleting a handle only ever affect the client
+    that uploaded it; `source_key` is the digest of the bytes and keys the
+    result cache, so identical uploads still share cached renders.
+
+    All arrays are read-only so a filter that writes to its input fails
+    loudly instead of corrupting the stored copy. `extras` holds per-image
+    state of stateful endpoints (e.g. a bgrem refinement session), is set
+    with ImageStore.set_extra() and is dropped with the image. Endpoints
+    that read, update and write back `extras` hold `lock` meanwhile, so
+    concurrent updates are not lost.
+    """
+    image_id: str
+    source_key: str
+    variants: dict
+    nbytes: int = 0
+    last_used: float = field(default_factory=time.monotonic)
+    extras: dict = field(default_factory=dict)
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+    @property
+    def original(self) -> np.ndarray:
+        return self.variants[max(self.variants)]
+
+    def variant(self, max_dim: int = None):
+        """
+        Returns (long_edge, image) for the smallest stored copy whose long edge
+        is at least `max_dim`, or the original when `max_dim` is None.
+        """
+        if max_dim is None:
+            long_edge = max(self.variants)
+        else:
+            long_edge = min((size for size in self.variants if size >= max_dim), default=max(self.variants))
+        return long_edge, self.variants[long_edge]
+
+    def describe(self) -> dict:
+        height, width = self.original.shape[:2]
+        return {
+            "image_id": self.image_id,
+            "width": width,
+            "height": height,
+            "variants": sorted(self.variants),
+        }
+
+
+def build_variants(img: np.ndarray) -> dict:
+    """Builds the downscaled copies of `img`, each from the previous one."""
+    variants = {max(img.shape[:2]): img}
+    current = img
+    for size in VARIANT_SIZES:
+        height, width = current.shape[:2]
+        scale = size / max(height, width)
+        if scale >= 1:
+            continue
+        current = cv2.resize(current, (max(1, round(width * scale)), max(1, round(height * scale))),
+                             interpolation=cv2.INTER_AREA)
+        variants[size] = current
+    for variant in variants.values():
+        variant.flags.writeable = False
+    return variants
+
+
+class ImageStore:
+    """
+    Decoded uploads kept in memory so filters can be applied to them by
+    handle. Bounded by total array size (LRU eviction) and by idle time.
+    """
+
+    def __init__(self, max_bytes: int, ttl_seconds: float):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.size = 0
+        self._images = OrderedDict()
+
+    def put(self, source_key: str, variants: dict) -> StoredImage:
+        """Keeps `variants` under a new handle; `source_key` is the digest of the upload."""
+        stored = StoredImage(secrets.token_urlsafe(16), source_key, variants,
+                             nbytes=sum(v.nbytes for v in variants.values()))
+        if stored.nbytes > self.max_bytes:
+            raise HTTPException(status_code=413, detail="Image is too large to keep in the image store")
+        self._images[stored.image_id] = stored
+        self.size += stored.nbytes
+        self._evict()
+        return stored
+
+    def get(self, image_id: str) -> StoredImage:
+        self._expire()
+        stored = self._images.get(image_id)
+        if stored is None:
+            raise HTTPException(status_code=404, detail=f"Unknown or expired image_id '{image_id}'")
+        stored.last_used = time.monotonic()
+        self._images.move_to_end(image_id)
+        return stored
+
+    def set_extra(self, stored: StoredImage, key: str, value):
+        """
+        Sets `stored.extras[key]`, counting the value's `nbytes` (if any)
+        against the store's bound like the image itself.
+        """
+        delta = getattr(value, "nbytes", 0) - getattr(stored.extras.get(key), "nbytes", 0)
+        stored.extras[key] = value
+        stored.nbytes += delta
+        if self._images.get(stored.image_id) is stored:
+            self.size += delta
+            self._evict()
+
+    def discard(self, image_id: str) -> bool:
+        stored = self._images.pop(image_id, None)
+        if stored is None:
+            return False
+        self.size -= stored.nbytes
+        return True
+
+    def _expire(self):
+        cutoff = time.monotonic() - self.ttl_seconds
+        while self._images:
+            image_id, stored = next(iter(self._images.items()))
+            if stored.last_used >= cutoff:
+                break
+            self.discard(image_id)
+
+    def _evict(self):
+        self._expire()
+        while self.size > self.max_bytes:
+            self.discard(next(iter(self._images)))
+
+
+images = ImageStore(
+    max_bytes=env_int("SHARPIFY_IMAGE_STORE_BYTES", 512 * 1024 * 1024),
+    ttl_seconds=env_int("SHARPIFY_IMAGE_TTL", 30 * 60),
+)
@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import secrets
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional
+
+from fastapi import HTTPException
+from services.utils import env_int
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Job:
+    job_id: str
+    media_type: str
+    status: str = "pending"  # "pending", "done" or "failed"
+    result: Optional[memoryview] = None
+    error: Optional[str] = None
+    status_code: Optional[int] = None
+    created_at: float = field(default_factory=time.monotonic)
+    finished_at: Optional[float] = None
+    task: Optional[asyncio.Task] = None
+
+    def describe(self) -> dict:
+        info = {"job_id": self.job_id, "status": self.status}
+        if self.error is not None:
+            info["error"] = self.error
+        return info
+
+
+class JobStore:
+    """
+    Background renders the client can poll by id.
+
+    Holds at most `max_jobs` jobs and `max_bytes` of finished results;
+    finished jobs are dropped oldest-first when room is needed and after
+    `ttl_seconds`. At most `max_running` jobs run at once and the rest wait
+    their turn, so background work only ever occupies that many worker
+    slots and requests someone is waiting for are not queued behind it.
+    """
+
+    def __init__(self, max_jobs: int, max_bytes: int, ttl_seconds: float, max_running: int):
+        self.max_jobs = max_jobs
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.size = 0
+        self._jobs = OrderedDict()
+        self._running = asyncio.Semaphore(max(1, max_running))
+
+    def submit(self, make_result, media_type: str, job_id: str = None) -> Optional[Job]:
+        """
+        Starts `make_result()` as a background job. It is a coroutine function
+        returning the encoded result as a bytes-like object.
+
+        Args:
+            make_result: Called only if a new job is actually started.
+            media_type: The content type of the result.
+            job_id: A deterministic id lets identical requests share one job.
+                    A random id is used when omitted.
+
+        Returns:
+            The new or existing job, or None if the store is full of
+            unfinished jobs.
+        """
+        self._expire()
+        job_id = job_id or secrets.token_urlsafe(16)
+        existing = self._jobs.get(job_id)
+        if existing is not None and existing.status != "failed":
+            return existing
+        self._remove(job_id)
+
+        if len(self._jobs) >= self.max_jobs and not self._drop_oldest_finished():
+            return None
+
+        job = Job(job_id, media_type)
+        job.task = asyncio.create_task(self._run(job, make_result))
+        self._jobs[job_id] = job
+        return job
+
+    def get(self, job_id: str) -> Job:
+        self._expire()
+        job = self._jobs.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"Unknown or expired job '{job_id}'")
+        return job
+
+    async def _run(self, job: Job, make_result):
+        try:
+            async with self._running:
+                result = memoryview(await make_result())
+            if result.nbytes > self.max_bytes:
+                raise HTTPException(status_code=413, detail="Result is too large to keep")
+            job.result, job.status = result, "done"
+            self.size += result.nbytes
+            self._evict(keep=job.job_id)
+        except HTTPException as e:
+            job.status, job.error, job.status_code = "failed", str(e.detail), e.status_code
+        except Exception as e:
+            logger.exception("Background job %s failed", job.job_id)
+            job.status, job.error, job.status_code = "failed", str(e), 500
+        finally:
+            job.finished_at = time.monotonic()
+            job.task = None
+
+    def _remove(self, job_id: str):
+        job = self._jobs.pop(job_id, None)
+        if job is not None and job.result is not None:
+            self.size -= job.result.nbytes
+
+    def _drop_oldest_finished(self, keep: str = None) -> bool:
+        for job_id, job in self._jobs.items():
+            if job.finished_at is not None and job_id != keep:
+                self._remove(job_id)
+                return True
+        return False
+
+    def _evict(self, keep: str):
+        """Drops the oldest finished jobs other than `keep` until results fit in max_bytes."""
+        while self.size > self.max_bytes and self._drop_oldest_finished(keep):
+            pass
+
+    def _expire(self):
+        cutoff = time.monotonic() - self.ttl_seconds
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job.finished_at is not None and job.finished_at < cutoff]:
+            self._remove(job_id)
+
+
+jobs = JobStore(
+    max_jobs=env_int("SHARPIFY_MAX_JOBS", 256),
+    max_bytes=env_int("SHARPIFY_JOB_BYTES", 256 * 1024 * 1024),
+    ttl_seconds=env_int("SHARPIFY_JOB_TTL", 10 * 60),
+    max_running=env_int("SHARPIFY_BACKGROUND_JOBS", 1),
+)
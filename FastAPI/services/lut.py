@@ -0,0 +1,29 @@
+import numpy as np
+
+# Every 8-bit input value, for building tables with vectorized expressions,
+# e.g. to_table(LEVELS * 1.2).
+LEVELS = np.arange(256, dtype=np.float64)
+
+
+def to_table(values, rounding: bool = True) -> np.ndarray:
+    """
+    Converts values computed for LEVELS into a read-only uint8 lookup table
+    for cv2.LUT, saturating to 0-255.
+
+    Args:
+        values: 256 output values, one per input level.
+        rounding: Round to nearest like cv2's saturate_cast. False truncates
+                  like numpy's astype(np.uint8) after clipping.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    values = np.rint(values) if rounding else np.floor(values)
+    table = np.clip(values, 0, 255).astype(np.uint8)
+    table.flags.writeable = False
+    return table
+
+
+def per_channel(tables) -> np.ndarray:
+    """Stacks one table per channel into the (256, 1, channels) form cv2.LUT expects."""
+    table = np.ascontiguousarray(np.stack(tables, axis=-1).reshape(256, 1, len(tables)))
+    table.flags.writeable = False
+    return table
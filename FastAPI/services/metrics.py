@@ -0,0 +1,267 @@
+"""
+Request and render metrics, served at /metrics in the Prometheus text format
+and echoed per request in a Server-Timing header.
+
+Render stages (queue, decode, filter, encode) are timed where they run, on
+the worker pools, with utils.StageTimer and recorded here when the result
+comes back; request stages (read, respond, send) are timed by
+MetricsMiddleware around the whole ASGI app.
+"""
+import bisect
+import math
+import threading
+import time
+from contextvars import ContextVar
+from typing import Callable, Optional
+
+from services import registry
+
+# Histogram bucket upper bounds.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+MEGAPIXEL_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 12, 16, 24, 48)
+BYTE_BUCKETS = (1e4, 3e4, 1e5, 3e5, 1e6, 3e6, 1e7, 3e7, 1e8)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_lock = threading.Lock()
+_metrics = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self._values = {}
+        _metrics.append(self)
+
+    def inc(self, *labels, amount: float = 1):
+        with _lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def collect(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_labels(self.labels, labels)} {_number(value)}")
+        return lines
+
+
+class Gauge:
+    """A gauge read when metrics are collected: `read()` maps label tuples to values."""
+
+    def __init__(self, name: str, help: str, labels: tuple, read: Callable[[], dict]):
+        self.name, self.help, self.labels, self.read = name, help, labels, read
+        _metrics.append(self)
+
+    def collect(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for labels, value in sorted(self.read().items()):
+            lines.append(f"{self.name}{_labels(self.labels, labels)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple, buckets: tuple):
+        self.name, self.help, self.labels = name, help, labels
+        self.buckets = tuple(buckets)
+        # Per label tuple: [counts per bucket plus +Inf, sum].
+        self._series = {}
+        _metrics.append(self)
+
+    def observe(self, value: float, *labels):
+        with _lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def collect(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labels, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, labels)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labels, labels)} {cumulative}")
+        return lines
+
+
+render_seconds = Histogram(
+    "sharpify_render_seconds",
+    "Time spent in each stage of a render: queue, decode, filter and encode.",
+    ("filter", "stage"), LATENCY_BUCKETS,
+)
+input_megapixels = Histogram(
+    "sharpify_input_megapixels",
+    "Size of rendered inputs after decoding and downscaling.",
+    ("filter",), MEGAPIXEL_BUCKETS,
+)
+output_bytes = Histogram(
+    "sharpify_output_bytes",
+    "Size of encoded render results.",
+    ("filter",), BYTE_BUCKETS,
+)
+cache_hits = Counter(
+    "sharpify_cache_hits_total",
+    "Renders served from the result cache.",
+    ("filter",),
+)
+errors = Counter(
+    "sharpify_errors_total",
+    "Renders that failed, by HTTP status (400 undecodable, 503 busy, 504 timed out, 500 crashed).",
+    ("filter", "status"),
+)
+request_seconds = Histogram(
+    "sharpify_request_seconds",
+    "Time spent in each stage of a request: read (receiving the body), respond "
+    "(until the response starts), send (streaming the response) and total.",
+    ("endpoint", "stage"), LATENCY_BUCKETS,
+)
+requests = Counter(
+    "sharpify_requests_total",
+    "Requests by endpoint and HTTP status.",
+    ("endpoint", "status"),
+)
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        for metric in _metrics:
+            if not isinstance(metric, Gauge):
+                lines.extend(metric.collect())
+    for metric in _metrics:
+        if isinstance(metric, Gauge):
+            lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+# Server-Timing entries of the current request as (name, seconds, desc);
+# None outside MetricsMiddleware.
+_server_timing: ContextVar[Optional[list]] = ContextVar("server_timing", default=None)
+
+
+def server_timing(name: str, seconds: float, desc: str = None):
+    """Adds an entry to the current request's Server-Timing header, if any."""
+    entries = _server_timing.get()
+    if entries is not None:
+        entries.append((name, seconds, desc))
+
+
+def record_render(label: str, timer, size: int):
+    """
+    Records a finished render.
+
+    Args:
+        label: The filter name, or "pipeline" for several steps.
+        timer: The utils.StageTimer the render was timed with.
+        size: Bytes of the encoded result.
+    """
+    for stage, step, seconds in timer.stages:
+        render_seconds.observe(seconds, step or label, stage)
+        server_timing(stage, seconds, step)
+    if timer.megapixels is not None:
+        input_megapixels.observe(timer.megapixels, label)
+    output_bytes.observe(size, label)
+
+
+def _format_server_timing(entries: list) -> str:
+    # Repeated stages (fanouts, preview plus full render) are summed.
+    totals = {}
+    for name, seconds, desc in entries:
+        totals[name, desc] = totals.get((name, desc), 0.0) + seconds
+    return ", ".join(
+        f"{name};dur={seconds * 1000:.1f}" + (f';desc="{_escape(desc)}"' if desc else "")
+        for (name, desc), seconds in totals.items()
+    )
+
+
+def _endpoint(scope) -> str:
+    """
+    The request path with path parameters put back as templates, e.g.
+    "/api/jobs/{job_id}", so labels stay few. Known filter names are kept.
+    """
+    if scope.get("route") is None:
+        return "unmatched"
+    templates = {str(value): "{" + name + "}" for name, value in scope.get("path_params", {}).items()
+                 if not (name == "filter_name" and value in registry.filter_names())}
+    return "/".join(templates.get(segment, segment) for segment in scope["path"].split("/"))
+
+
+class MetricsMiddleware:
+    """
+    Times every HTTP request and adds the Server-Timing header.
+
+    The header lists the time taken to receive the body (read), each render
+    stage of the request (queue, decode, filter, encode; cache for results
+    served from the cache) and the time until the response started
+    (respond). Streaming the response (send) happens after the header went
+    out, so it only appears in /metrics.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        entries = []
+        token = _server_timing.set(entries)
+        marks = {}
+
+        async def timed_receive():
+            message = await receive()
+            if message["type"] == "http.request" and not message.get("more_body", False):
+                marks.setdefault("read", time.perf_counter())
+            return message
+
+        async def timed_send(message):
+            if message["type"] == "http.response.start":
+                marks["respond"] = time.perf_counter()
+                marks["status"] = message["status"]
+                if "read" in marks:
+                    entries.insert(0, ("read", marks["read"] - start, None))
+                entries.append(("respond", marks["respond"] - start, None))
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", _format_server_timing(entries).encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                marks["sent"] = time.perf_counter()
+
+        try:
+            await self.app(scope, timed_receive, timed_send)
+        finally:
+            _server_timing.reset(token)
+            end = time.perf_counter()
+            endpoint = _endpoint(scope)
+            requests.inc(endpoint, str(marks.get("status", 500)))
+            if "read" in marks:
+                request_seconds.observe(marks["read"] - start, endpoint, "read")
+            if "respond" in marks:
+                request_seconds.observe(marks["respond"] - start, endpoint, "respond")
+                if "sent" in marks:
+                    request_seconds.observe(marks["sent"] - marks["respond"], endpoint, "send")
+            request_seconds.observe(end - start, endpoint, "total")
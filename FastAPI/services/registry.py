@@ -0,0 +1,341 @@
+import importlib
+import logging
+import os
+import pkgutil
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Type, Union
+
+from fastapi import HTTPException
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+from services.utils import env_int
+
+logger = logging.getLogger(__name__)
+
+# Packages scanned for filter modules. Each module declares a module-level
+# `SPEC = FilterSpec(...)` whose name matches the module name, so filters can
+# be indexed from the file names alone and imported on first use.
+FILTER_PACKAGES = ("services.filters", "services.enhance")
+
+COST_CLASSES = ("light", "medium", "heavy")
+
+# Default per-request timeout in seconds for each cost class.
+COST_TIMEOUTS = {"light": 15.0, "medium": 30.0, "heavy": 60.0}
+
+# Server-wide cap on the long edge of images fed to filters; 0 disables it.
+MAX_DIM = env_int("SHARPIFY_MAX_DIM", 4096) or None
+
+# Long edge used to render ?preview=true requests.
+PREVIEW_DIM = env_int("SHARPIFY_PREVIEW_DIM", 512)
+
+# Upper bound on the number of steps in a single /api/pipeline request.
+MAX_PIPELINE_STEPS = 10
+
+# Upper bound on the number of filters in a single /api/fanout request.
+MAX_FANOUT_FILTERS = 32
+
+MEDIA_TYPES = {
+    ".jpg": "image/jpeg",
+    ".png": "image/png",
+    ".webp": "image/webp",
+    ".txt": "text/plain; charset=utf-8",
+    ".html": "text/html; charset=utf-8",
+}
+
+# Formats whose results are text rather than an image; a step producing one
+# can only be the last step of a pipeline.
+TEXT_FORMATS = (".txt", ".html")
+
+
+class NoParams(BaseModel):
+    pass
+
+
+@dataclass(frozen=True)
+class FilterSpec:
+    """
+    Everything the dispatcher needs to know about a filter.
+
+    Args:
+        name: The public name, served at /api/{name}.
+        func: A module-level function taking a BGR ndarray plus the fields of
+              `params` as keyword arguments and returning an ndarray.
+        params: A pydantic model describing the query parameters.
+        format: The default output format. ".png" for line art and flat
+                colours, which compress better losslessly; requests may ask
+                for another (see encoding.OutputOptions).
+        formats: Alternative output formats, mapping values of the filter's
+                 `output` parameter to extensions. `func` returns a str for
+                 the formats in TEXT_FORMATS.
+        cost: One of "light", "medium" or "heavy".
+        pool: "thread" for OpenCV-bound filters, "process" for filters that
+              hold the GIL in Python code.
+        deterministic: False for filters that draw random numbers; their
+                       results are only cached when a `seed` is given.
+        max_dim: Default cap on the input's long edge when the request does
+                 not pass ?max_dim=.
+        preview_params: Keyword arguments merged over the validated params in
+                        preview mode, trading quality for speed (e.g. fewer
+                        iterations). Not exposed as query parameters.
+        max_pending: Optional cap on requests in flight for this filter.
+        timeout: Seconds before the request is abandoned with 504. Defaults
+                 to the cost class timeout.
+        under_load: Optional `(params, load) -> params` hook called before
+                    a request runs, with `load` between 0 (idle) and 1 (about
+                    to reject with 503). Lets a filter switch to a cheaper
+                    variant when the server is busy; results are cached
+                    under the returned params.
+    """
+    name: str
+    func: Callable
+    params: Type[BaseModel] = NoParams
+    format: str = ".jpg"
+    formats: Optional[dict] = None
+    cost: str = "light"
+    pool: str = "thread"
+    deterministic: bool = True
+    max_dim: Optional[int] = None
+    preview_params: Optional[dict] = None
+    max_pending: Optional[int] = None
+    timeout: Optional[float] = None
+    under_load: Optional[Callable] = None
+
+    def __post_init__(self):
+        if self.cost not in COST_CLASSES:
+            raise ValueError(f"Unknown cost class {self.cost!r} for filter {self.name!r}")
+        if self.pool not in ("thread", "process"):
+            raise ValueError(f"Unknown pool {self.pool!r} for filter {self.name!r}")
+
+    @property
+    def media_type(self) -> str:
+        return MEDIA_TYPES[self.format]
+
+    def format_for(self, params: dict) -> str:
+        """The output extension for a request with the given validated params."""
+        return (self.formats or {}).get(params.get("output"), self.format)
+
+    def media_type_for(self, params: dict) -> str:
+        return MEDIA_TYPES[self.format_for(params)]
+
+    @property
+    def time_limit(self) -> float:
+        return self.timeout if self.timeout is not None else COST_TIMEOUTS[self.cost]
+
+    def is_cacheable(self, params: dict) -> bool:
+        return self.deterministic or params.get("seed") is not None
+
+    def with_preview(self, params: dict) -> dict:
+        return {**params, **(self.preview_params or {})}
+
+    def parse_params(self, values, loc: tuple = ("query",)) -> dict:
+        """Validates raw parameter values and returns keyword arguments for `func`."""
+        try:
+            model = self.params.model_validate(dict(values))
+        except ValidationError as e:
+            errors = e.errors(include_url=False)
+            raise RequestValidationError([{**err, "loc": (*loc, *err["loc"])} for err in errors])
+        return model.model_dump()
+
+    def describe(self) -> dict:
+        return {
+            "name": self.name,
+            "format": self.format,
+            "media_type": self.media_type,
+            "formats": self.formats,
+            "cost": self.cost,
+            "pool": self.pool,
+            "max_dim": self.max_dim,
+            "params": self.params.model_json_schema(by_alias=True),
+        }
+
+
+class PipelineStep(BaseModel):
+    filter: str
+    params: Dict[str, object] = Field(default_factory=dict)
+
+
+_pipeline_adapter = TypeAdapter(List[PipelineStep])
+_fanout_adapter = TypeAdapter(List[Union[str, PipelineStep]])
+
+
+_SERVICES_DIR = Path(__file__).resolve().parent
+
+_modules = {}
+_filters = {}
+_import_ms = {}
+
+
+def _index() -> dict:
+    if not _modules:
+        for package in FILTER_PACKAGES:
+            package_dir = _SERVICES_DIR / package.split(".", 1)[1]
+            for module_info in pkgutil.iter_modules([str(package_dir)]):
+                if module_info.name in _modules:
+                    raise RuntimeError(f"Duplicate filter name {module_info.name!r}")
+                _modules[module_info.name] = f"{package}.{module_info.name}"
+    return _modules
+
+
+def _load(name: str) -> FilterSpec:
+    module_path = _index()[name]
+    start = time.perf_counter()
+    module = importlib.import_module(module_path)
+    _import_ms[name] = (time.perf_counter() - start) * 1000
+
+    spec = getattr(module, "SPEC", None)
+    if spec is None or spec.name != name:
+        raise RuntimeError(f"{module_path} must declare SPEC = FilterSpec(name={name!r}, ...)")
+    _filters[name] = spec
+    return spec
+
+
+def filter_names() -> list:
+    """Names of all available filters, without importing any of them."""
+    return sorted(_index())
+
+
+def get_filter(name: str) -> FilterSpec:
+    spec = _filters.get(name)
+    if spec is not None:
+        return spec
+    if name not in _index():
+        raise HTTPException(status_code=404, detail=f"Unknown filter '{name}'")
+    return _load(name)
+
+
+def all_filters() -> dict:
+    """Imports every filter module; prefer get_filter() on request paths."""
+    return {name: get_filter(name) for name in filter_names()}
+
+
+def warm_up(names=None) -> list:
+    """
+    Imports a hot set of filters ahead of the first request.
+
+    Args:
+        names: Filter names to preload. Defaults to the comma-separated
+               SHARPIFY_PRELOAD environment variable; "*" preloads everything.
+
+    Returns:
+        The import report (see import_report()).
+    """
+    if names is None:
+        names = [n.strip() for n in os.environ.get("SHARPIFY_PRELOAD", "").split(",") if n.strip()]
+    if "*" in names:
+        names = filter_names()
+    for name in names:
+        if name not in _index():
+            logger.warning("SHARPIFY_PRELOAD: unknown filter %r", name)
+            continue
+        get_filter(name)
+
+    report = import_report()
+    loaded = [entry for entry in report if entry["loaded"]]
+    if loaded:
+        logger.info(
+            "Preloaded %d filters in %.1f ms: %s",
+            len(loaded),
+            sum(entry["import_ms"] for entry in loaded),
+            ", ".join(f"{entry['name']}={entry['import_ms']:.1f}ms" for entry in loaded),
+        )
+    return report
+
+
+def import_report() -> list:
+    """Per-module import cost in milliseconds for every filter loaded so far."""
+    return [
+        {
+            "name": name,
+            "module": module_path,
+            "loaded": name in _filters,
+            "import_ms": round(_import_ms[name], 2) if name in _import_ms else None,
+        }
+        for name, module_path in sorted(_index().items())
+    ]
+
+
+def resolve_max_dim(specs: list, requested: Optional[int] = None) -> Optional[int]:
+    """
+    The long-edge cap for a request: the requested value, else the tightest
+    per-filter default, never above the server-wide MAX_DIM.
+    """
+    if requested is not None:
+        limits = [requested]
+    else:
+        limits = [spec.max_dim for spec in specs if spec.max_dim is not None]
+    if MAX_DIM is not None:
+        limits.append(MAX_DIM)
+    return min(limits) if limits else None
+
+
+def _parse_steps(raw: str, adapter: TypeAdapter, max_steps: int, count_msg: str, loc: tuple) -> list:
+    try:
+        steps = adapter.validate_json(raw)
+    except ValidationError as e:
+        errors = e.errors(include_url=False)
+        raise RequestValidationError([{**err, "loc": (*loc, *err["loc"])} for err in errors])
+
+    if not 1 <= len(steps) <= max_steps:
+        raise RequestValidationError([{
+            "type": "value_error",
+            "loc": loc,
+            "msg": count_msg,
+            "input": len(steps),
+        }])
+
+    resolved = []
+    for i, step in enumerate(steps):
+        if isinstance(step, str):
+            step = PipelineStep(filter=step)
+        if step.filter not in _index():
+            raise RequestValidationError([{
+                "type": "value_error",
+                "loc": (*loc, i, "filter"),
+                "msg": f"Unknown filter '{step.filter}'",
+                "input": step.filter,
+            }])
+        spec = get_filter(step.filter)
+        resolved.append((spec, spec.parse_params(step.params, loc=(*loc, i, "params"))))
+    return resolved
+
+
+def reject_text_output(steps: list, loc: tuple, msg: str, indices=None):
+    """Raises a validation error for the first of `steps` (at `indices`) producing text."""
+    for i in range(len(steps)) if indices is None else indices:
+        spec, params = steps[i]
+        if spec.format_for(params) in TEXT_FORMATS:
+            raise RequestValidationError([{
+                "type": "value_error",
+                "loc": (*loc, i, "params", "output"),
+                "msg": msg,
+                "input": params.get("output"),
+            }])
+
+
+def parse_pipeline(raw: str, loc: tuple = ("body", "steps")) -> list:
+    """
+    Parses a JSON list of steps such as
+    ``[{"filter": "auto_enhance"}, {"filter": "sharpen", "params": {"amount": 1.5}}]``.
+
+    Returns:
+        A list of (FilterSpec, params) pairs ready for executor.run_pipeline().
+    """
+    steps = _parse_steps(raw, _pipeline_adapter, MAX_PIPELINE_STEPS,
+                         f"A pipeline needs between 1 and {MAX_PIPELINE_STEPS} steps", loc)
+    reject_text_output(steps, loc, "Only the last step of a pipeline may produce text output",
+                       indices=range(len(steps) - 1))
+    return steps
+
+
+def parse_fanout(raw: str, loc: tuple = ("body", "filters")) -> list:
+    """
+    Parses the JSON list of filters for /api/fanout. Entries are filter names
+    or steps as in parse_pipeline(), e.g. ``["sketch", {"filter": "dot", "params": {"mode": "cmyk"}}]``.
+
+    Returns:
+        A list of (FilterSpec, params) pairs, each rendered on its own.
+    """
+    return _parse_steps(raw, _fanout_adapter, MAX_FANOUT_FILTERS,
+                        f"A fanout needs between 1 and {MAX_FANOUT_FILTERS} filters", loc)
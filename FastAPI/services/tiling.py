@@ -0,0 +1,97 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from services.utils import env_int
+
+# Long edge of the tiles images are split into, excluding the halo.
+TILE_SIZE = env_int("SHARPIFY_TILE_SIZE", 1024)
+
+# Threads shared by every tiled call in this process. Filter jobs already
+# run on a worker pool, so this bounds the total fan-out rather than being
+# sized per request.
+TILE_WORKERS = env_int("SHARPIFY_TILE_WORKERS", os.cpu_count() or 1)
+
+_executor = None
+
+
+def _tile_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=max(1, TILE_WORKERS), thread_name_prefix="sharpify-tile")
+    return _executor
+
+
+def tile_boxes(height: int, width: int, tile_size: int, halo: int) -> list:
+    """
+    Splits a height x width image into tiles.
+
+    Returns:
+        A list of (inner, outer) boxes, each (top, bottom, left, right). The
+        inner boxes cover the image exactly once; each outer box is its inner
+        box grown by `halo` pixels on every side, clipped to the image.
+    """
+    boxes = []
+    for top in range(0, height, tile_size):
+        bottom = min(height, top + tile_size)
+        for left in range(0, width, tile_size):
+            right = min(width, left + tile_size)
+            outer = (max(0, top - halo), min(height, bottom + halo),
+                     max(0, left - halo), min(width, right + halo))
+            boxes.append(((top, bottom, left, right), outer))
+    return boxes
+
+
+def map_tiles(fn, img: np.ndarray, halo: int, tile_size: int = None) -> np.ndarray:
+    """
+    Applies `fn` to overlapping tiles of `img` in parallel and stitches the
+    results.
+
+    The result matches `fn(img)` exactly when every output pixel of `fn`
+    depends only on input pixels at most `halo` pixels away: tiles touching
+    the image edge see the same border as the whole image would, and interior
+    tiles see their real neighbours. Filters with global steps (normalizing,
+    clustering) should tile only their local part.
+
+    Args:
+        fn: Takes an image and returns one of the same height and width.
+        img: The input image.
+        halo: Pixels of context each tile needs beyond its own area.
+        tile_size: Defaults to TILE_SIZE.
+
+    Returns:
+        The stitched result.
+    """
+    tile_size = tile_size or TILE_SIZE
+    height, width = img.shape[:2]
+    if height <= tile_size and width <= tile_size:
+        return fn(img)
+
+    boxes = tile_boxes(height, width, tile_size, halo)
+
+    def run(box):
+        (top, bottom, left, right), (o_top, o_bottom, o_left, o_right) = box
+        result = fn(img[o_top:o_bottom, o_left:o_right])
+        return result[top - o_top:bottom - o_top, left - o_left:right - o_left]
+
+    # The first tile fixes the output's dtype and channels; the rest write
+    # their own disjoint area as soon as they finish.
+    first = run(boxes[0])
+    out = np.empty((height, width) + first.shape[2:], dtype=first.dtype)
+
+    def run_into(box):
+        top, bottom, left, right = box[0]
+        out[top:bottom, left:right] = run(box)
+
+    (top, bottom, left, right), _ = boxes[0]
+    out[top:bottom, left:right] = first
+    for _ in _tile_executor().map(run_into, boxes[1:]):
+        pass
+    return out
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
@@ -1,16 +1,148 @@
+import os
+import time
+from contextlib import contextmanager
 import cv2
 import numpy as np
 from fastapi import UploadFile
 from io import BytesIO
 
+
+def env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+class ImageDecodeError(ValueError):
+    pass
+
+
+class StageTimer:
+    """
+    Wall time of the stages of one render, e.g. decode, filter and encode.
+    Plain data, so a process pool worker can send it back with its result;
+    see metrics.record_render().
+    """
+
+    def __init__(self):
+        # (stage, step, seconds); step names the filter of a "filter" stage.
+        self.stages = []
+        self.megapixels = None
+
+    @contextmanager
+    def stage(self, stage: str, step: str = None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append((stage, step, time.perf_counter() - start))
+
+    @property
+    def total(self) -> float:
+        return sum(seconds for _, _, seconds in self.stages)
+
+
+# JPEG start-of-frame markers carrying the image size (all SOFn except DHT,
+# JPG and DAC, which share the 0xC4/0xC8/0xCC code points).
+_JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+# IMREAD_REDUCED_* decode the JPEG DCT at 1/2, 1/4 or 1/8 scale, which is much
+# faster than a full decode followed by a resize.
+_REDUCED_DECODE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+
+def jpeg_size(contents: bytes):
+    """Reads (width, height) from a JPEG header without decoding, or returns None."""
+    if contents[:2] != b"\xff\xd8":
+        return None
+    i = 2
+    while i + 9 <= len(contents):
+        if contents[i] != 0xFF:
+            return None
+        marker = contents[i + 1]
+        if marker == 0xFF:
+            # Fill byte before a marker.
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            # Standalone markers without a length field.
+            i += 2
+            continue
+        if marker in _JPEG_SOF_MARKERS:
+            height = int.from_bytes(contents[i + 5:i + 7], "big")
+            width = int.from_bytes(contents[i + 7:i + 9], "big")
+            return width, height
+        i += 2 + int.from_bytes(contents[i + 2:i + 4], "big")
+    return None
+
+
+def resize_to_fit(img, max_dim: int = None):
+    """Area-downscales `img` so its long edge is at most `max_dim`; never upscales."""
+    if max_dim is None:
+        return img
+    height, width = img.shape[:2]
+    scale = max_dim / max(height, width)
+    if scale >= 1:
+        return img
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+
+def decode_image(contents: bytes, max_dim: int = None):
+    """
+    Decodes an uploaded image to BGR.
+
+    With `max_dim`, JPEGs are decoded at the smallest DCT reduction that still
+    covers `max_dim`, then area-resized to the exact target. Other formats are
+    decoded in full and resized.
+    """
+    flag = cv2.IMREAD_COLOR
+    if max_dim is not None:
+        size = jpeg_size(contents)
+        if size is not None:
+            long_edge = max(size)
+            for factor, reduced_flag in _REDUCED_DECODE_FLAGS:
+                if long_edge // factor >= max_dim:
+                    flag = reduced_flag
+                    break
+
+    if not contents:
+        raise ImageDecodeError("The uploaded image is empty")
+    try:
+        img = cv2.imdecode(np.frombuffer(contents, np.uint8), flag)
+    except cv2.error:
+        img = None
+    if img is None:
+        raise ImageDecodeError("Could not decode the uploaded image")
+    return resize_to_fit(img, max_dim)
+
+def as_bgr(img):
+    if img.ndim == 2:
+        return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    if img.shape[2] == 4:
+        return cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+    return img
+
 async def read_image_from_upload(file: UploadFile):
     contents = await file.read()
-    np_arr = np.frombuffer(contents, np.uint8)
-    img = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-    return img
+    return decode_image(contents)
 
-def encode_image_to_bytes(img, format: str = ".jpg"):
-    success, encoded = cv2.imencode(format, img)
+def encode_image(img, format: str = ".jpg", params=()):
+    """
+    Encodes `img` and returns cv2's own output buffer as a flat uint8 array.
+    It supports the buffer protocol, so it can be wrapped in a memoryview and
+    sent without copying.
+
+    Args:
+        params: cv2.IMWRITE_* flag/value pairs, flattened.
+    """
+    success, encoded = cv2.imencode(format, img, list(params))
     if not success:
         raise ValueError("Failed to encode image")
-    return BytesIO(encoded.tobytes())
+    return encoded.reshape(-1)
+
+def encode_image_to_bytes(img, format: str = ".jpg"):
+    return BytesIO(encode_image(img, format))